@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import math
+import struct
+
+
+class BloomFilter(object):
+    def __init__(self, capacity, error_rate=0.001):
+        if capacity <= 0 or not 0 < error_rate < 1:
+            raise ValueError('capacity must be positive and error_rate in (0, 1)')
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.num_bits = int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.num_hashes = max(1, int(round(self.num_bits * math.log(2) / capacity)))
+        self.bits = bytearray((self.num_bits + 7) // 8)
+        self.count = 0
+
+    def _positions(self, key):
+        # double hashing, k positions out of one md5
+        h1, h2 = struct.unpack('<QQ', hashlib.md5(key).digest())
+        h2 |= 1
+        return [(h1 + i * h2) % self.num_bits for i in range(self.num_hashes)]
+
+    def add(self, key):
+        found = True
+        for p in self._positions(key):
+            mask = 1 << (p & 7)
+            if not self.bits[p >> 3] & mask:
+                found = False
+                self.bits[p >> 3] |= mask
+        if not found:
+            self.count += 1
+        return found
+
+    def __contains__(self, key):
+        return all(self.bits[p >> 3] & (1 << (p & 7)) for p in self._positions(key))
+
+    def __len__(self):
+        return self.count
+
+    @property
+    def memory(self):
+        return len(self.bits)
+
+
+class ScalableBloomFilter(object):
+    def __init__(self, initial_capacity=100000, error_rate=0.001, growth=2, tightening=0.8):
+        self.initial_capacity = initial_capacity
+        self.error_rate = error_rate
+        self.growth = growth
+        self.tightening = tightening
+        self.filters = []
+
+    def _grow(self):
+        # the error rates of the stages form a geometric series bounded by error_rate
+        n = len(self.filters)
+        capacity = self.initial_capacity * self.growth ** n
+        error_rate = self.error_rate * (1 - self.tightening) * self.tightening ** n
+        f = BloomFilter(capacity, error_rate)
+        self.filters.append(f)
+        return f
+
+    def add(self, key):
+        if key in self:
+            return True
+        f = self.filters[-1] if self.filters else None
+        if f is None or f.count >= f.capacity:
+            f = self._grow()
+        f.add(key)
+        return False
+
+    def __contains__(self, key):
+        return any(key in f for f in reversed(self.filters))
+
+    def __len__(self):
+        return sum(f.count for f in self.filters)
+
+    @property
+    def memory(self):
+        return sum(f.memory for f in self.filters)
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+import logging
+import time
+from random import Random
+
+from scrapy.commands import ScrapyCommand
+from scrapy.exceptions import UsageError
+
+from house.items import SecondhandHouseItem, NewHouseItem, SoldHouseItem
+from house.loaders import SecondhandHouseLoader, NewHouseLoader, SoldHouseLoader, \
+    normalize_secondhand, normalize_new, normalize_sold
+
+logger = logging.getLogger(__name__)
+
+# values as the listing callbacks pass them
+typical = {
+    'secondhand': {'city': u'北京', 'title': u'南北通透 满五唯一 近地铁', 'room': u' 2室1厅 ', 'b_year': u'中楼层(共6层)2004年建板楼  -  ',
+                   'comm': u'天通苑北一区', 'id': u'101101234567', 'main': u'昌平', 'sub': u'天通苑', 'space': u' 89.5平米 ',
+                   'tags': [u'subway', u'taxfree', u'haskey'], 'total': u'350', 'unit': u'39106'},
+    'sold': {'city': u'北京', 'main': u'昌平', 'comm': u'天通苑北一区', 'info': u'南 北 | 精装', 'deal': u'2017.03.12',
+             'total': u'320', 'unit': u'35000', 'hang': u'挂牌330万', 'period': u'成交周期35天', 'room': u'2室1厅',
+             'space': u'89.5平米', 'b_year': u'高楼层(共18层) 2004年建板楼', 'id': u'101100654321'},
+    'new': {'city': u'北京', 'title': u'首开龙湖', 'p_type': u'住宅', 'price': u'均价45000元/平', 'id': u'bj123',
+            'sub': u'亦庄', 'dev': u'首开', 'open': u'2017-03-01', 'over': u'2018-12-31', 'f_space': u'12,000㎡',
+            'b_space': u'45,000平米', 'p_year': u'70年'},
+}
+# odd inputs the equivalence check draws from
+samples = [None, '', u'', u' ', u'\xa0', u'|', u' 2室1厅\xa0', u'1,234.5㎡', u'2004年', u'无', u'tag subway',
+           u'2017.03.12', u'12.5万', '350', '\xe5\x8c\x97\xe4\xba\xac', [], [u''], [u'tag a', u'taxfree'],
+           (u'1', u'2'), [None, u'x']]
+kinds = {'secondhand': (SecondhandHouseLoader, SecondhandHouseItem, normalize_secondhand),
+         'sold': (SoldHouseLoader, SoldHouseItem, normalize_sold),
+         'new': (NewHouseLoader, NewHouseItem, normalize_new)}
+
+
+def load(kind, values):
+    loader_class, item_class, _ = kinds[kind]
+    try:
+        loader = loader_class(item=item_class())
+        for k, v in values.items():
+            loader.add_value(k, v)
+        return dict(loader.load_item())
+    except Exception:
+        # with several bad fields the one failing first depends on the field order
+        return Exception
+
+
+def normalize(kind, values):
+    try:
+        return dict(kinds[kind][2](**values))
+    except Exception:
+        return Exception
+
+
+class Command(ScrapyCommand):
+
+    requires_project = True
+
+    def syntax(self):
+        return '[options]'
+
+    def short_desc(self):
+        return 'Check item normalizers against the item loaders and benchmark both'
+
+    def add_options(self, parser):
+        ScrapyCommand.add_options(self, parser)
+        parser.add_option("-c", "--cases", type="int", metavar="N", default=2000,
+                          help="random inputs checked per item class (default: 2000)")
+        parser.add_option("-n", "--number", type="int", metavar="N", default=20000,
+                          help="items built per item class and path (default: 20000)")
+        parser.add_option("--seed", type="int", metavar="N", default=0,
+                          help="seed of the random inputs (default: 0)")
+
+    def process_options(self, args, opts):
+        ScrapyCommand.process_options(self, args, opts)
+        if opts.cases < 0:
+            raise UsageError("Invalid -c value, must not be negative", print_help=False)
+        if opts.number <= 0:
+            raise UsageError("Invalid -n value, must be positive", print_help=False)
+
+    def run(self, args, opts):
+        r = Random(opts.seed)
+        for kind in sorted(kinds):
+            _, item_class, normalize_item = kinds[kind]
+            fields = sorted(item_class.fields)
+            cases = [typical[kind]]
+            for _ in range(opts.cases):
+                cases.append(dict((f, r.choice(samples)) for f in r.sample(fields, r.randint(1, len(fields)))))
+            differ = 0
+            for values in cases:
+                expected, got = load(kind, values), normalize(kind, values)
+                if expected != got:
+                    differ += 1
+                    if differ <= 5:
+                        logger.error('%s differs for %r: loader %r, normalizer %r', kind, values, expected, got)
+            if differ:
+                self.exitcode = 1
+
+            values = typical[kind]
+            started = time.time()
+            for _ in xrange(opts.number):
+                load(kind, values)
+            loader_rate = opts.number / max(time.time() - started, 1e-9)
+            started = time.time()
+            for _ in xrange(opts.number):
+                normalize_item(**values)
+            normalizer_rate = opts.number / max(time.time() - started, 1e-9)
+            logger.info('%s: %d inputs, %d differ, loader %.0f items/s, normalizer %.0f items/s, %.1fx.',
+                        kind, len(cases), differ, loader_rate, normalizer_rate, normalizer_rate / loader_rate)
@@ -0,0 +1,120 @@
+import glob
+import logging
+import os
+import timeit
+
+from scrapy.commands import ScrapyCommand
+from scrapy.exceptions import UsageError
+from scrapy.http import HtmlResponse
+from scrapy.selector import Selector
+
+from house.extractors import secondhand_cards, sold_cards
+
+logger = logging.getLogger(__name__)
+
+# pages modeled on the site's listing markup, the *_broken ones have cards missing fields
+fixtures = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'fixtures')
+
+
+def columns_secondhand(sel):
+    # the whole document queries the spider ran before house.extractors, kept as the baseline
+    price_infos = sel.xpath('//div[@class="priceInfo"]')
+    totals = price_infos.xpath('div[@class="totalPrice"]/span/text()').extract()
+    units = price_infos.xpath('div[@class="unitPrice"]/@data-price').extract()
+    ids = price_infos.xpath('div[@class="unitPrice"]/@data-hid').extract()
+    titles = sel.xpath('//div[@class="title"]/a/text()').extract()
+    house_infos = sel.xpath('//div[@class="address"]/div[@class="houseInfo"]')
+    communities = house_infos.xpath('a/text()').extract()
+    infos = house_infos.xpath('text()').extract()
+    built_years = sel.xpath('//div[@class="flood"]/div[@class="positionInfo"]/text()').extract()
+    sub_areas = sel.xpath('//div[@class="flood"]/div[@class="positionInfo"]/a/text()').extract()
+    tags = [tag.xpath('span/@class').extract() for tag in sel.xpath('//div[@class="tag"]')]
+    attrs = [titles, communities, infos, built_years, sub_areas, tags, totals, units, ids]
+    return [dict(title=titles[i], comm=communities[i], info=infos[i], b_year=built_years[i], sub=sub_areas[i],
+                 tags=tags[i], total=totals[i], unit=units[i], id=ids[i])
+            for i in range(min(len(a) for a in attrs))]
+
+
+def columns_sold(sel):
+    house_links = sel.xpath('//div[@class="title"]/a/@href').extract()
+    house_ids = [link.split('/')[-1].split('.')[0] for link in house_links]
+    content = sel.xpath('//ul[@class="listContent"]')
+    address = content.xpath('.//div[@class="address"]')
+    totals = address.xpath('div[@class="totalPrice"]/span/text()').extract()
+    flood = content.xpath('.//div[@class="flood"]')
+    units = flood.xpath('div[@class="unitPrice"]/span/text()').extract()
+    titles = sel.xpath('//div[@class="title"]/a/text()').extract()
+    house_infos = address.xpath('div[@class="houseInfo"]/text()').extract()
+    deals = address.xpath('div[@class="dealDate"]/text()').extract()
+    built_years = flood.xpath('div[@class="positionInfo"]/text()').extract()
+    hangs = content.xpath('.//div[@class="dealCycleeInfo"]/span[@class="dealCycleTxt"]/span[1]/text()').extract()
+    periods = content.xpath('.//div[@class="dealCycleeInfo"]/span[@class="dealCycleTxt"]/span[2]/text()').extract()
+    attrs = [house_ids, titles, house_infos, deals, totals, built_years, units, hangs, periods]
+    return [dict(id=house_ids[i], title=titles[i], info=house_infos[i], deal=deals[i], total=totals[i],
+                 b_year=built_years[i], unit=units[i], hang=hangs[i], period=periods[i])
+            for i in range(min(len(a) for a in attrs))]
+
+
+class Command(ScrapyCommand):
+
+    requires_project = True
+    kinds = {'secondhand': (columns_secondhand, secondhand_cards),
+             'sold': (columns_sold, sold_cards)}
+
+    def syntax(self):
+        return '[options] [page.html ...]'
+
+    def short_desc(self):
+        return 'Benchmark listing page extraction on saved pages'
+
+    def add_options(self, parser):
+        ScrapyCommand.add_options(self, parser)
+        parser.add_option("-k", "--kind", metavar="KIND", default="secondhand",
+                          help="listing page kind, secondhand or sold (default: secondhand)")
+        parser.add_option("-n", "--number", type="int", metavar="N", default=50,
+                          help="times every page is extracted (default: 50)")
+
+    def process_options(self, args, opts):
+        ScrapyCommand.process_options(self, args, opts)
+        if opts.kind not in self.kinds:
+            raise UsageError("Invalid -k value, use %s" % ' or '.join(sorted(self.kinds)), print_help=False)
+        if opts.number <= 0:
+            raise UsageError("Invalid -n value, must be positive", print_help=False)
+
+    def run(self, args, opts):
+        if not args:
+            args = sorted(glob.glob(os.path.join(fixtures, '%s*.html' % opts.kind)))
+        columns, cards = self.kinds[opts.kind]
+        totals = {'parse': 0.0, 'columns': 0.0, 'cards': 0.0}
+        for path in args:
+            with open(path, 'rb') as f:
+                response = HtmlResponse(url='file://' + path, body=f.read(), encoding='utf-8')
+            sel = Selector(response)
+            old, new = columns(sel), cards.extract(sel)
+            # parsing is shared by both, it is timed once on its own
+            parse = min(timeit.repeat(lambda: Selector(response), number=1, repeat=opts.number))
+            old_time = min(timeit.repeat(lambda: columns(sel), number=1, repeat=opts.number))
+            new_time = min(timeit.repeat(lambda: cards.extract(sel), number=1, repeat=opts.number))
+            totals['parse'] += parse
+            totals['columns'] += old_time
+            totals['cards'] += new_time
+            logger.info('%s: %d records before, %d now, %d differ, parse %.2fms, '
+                        'columns %.2fms, cards %.2fms', path, len(old), len(new),
+                        self._differ(old, new), parse * 1000, old_time * 1000, new_time * 1000)
+        pages = len(args)
+        logger.info('Per page: parse %.2fms, columns %.2fms, cards %.2fms, extraction %.1fx faster.',
+                    totals['parse'] * 1000 / pages, totals['columns'] * 1000 / pages,
+                    totals['cards'] * 1000 / pages, totals['columns'] / max(totals['cards'], 1e-9))
+
+    def _differ(self, old, new):
+        # records the column zip shifted or dropped show up here
+        differ = abs(len(old) - len(new))
+        for o, n in zip(old, new):
+            if any(self._strip(o[k]) != self._strip(n[k]) for k in o):
+                differ += 1
+        return differ
+
+    def _strip(self, value):
+        if value is None:
+            return u''
+        return value.strip() if isinstance(value, basestring) else value
@@ -0,0 +1,189 @@
+import logging
+import re
+import time
+from urlparse import urlparse
+
+from hbase import Hbase
+from scrapy.commands import ScrapyCommand
+from scrapy.exceptions import UsageError
+from twisted.internet import defer, reactor
+from twisted.internet.endpoints import TCP4ClientEndpoint
+from twisted.web.client import Agent, ProxyAgent, readBody
+from twisted.web.http_headers import Headers
+
+from house.storage import StorageUnavailable, backend_from_settings
+
+logger = logging.getLogger(__name__)
+
+
+class Command(ScrapyCommand):
+
+    requires_project = True
+    column_family = 'cf'
+    ip_re = re.compile(r'\b(?:\d{1,3}\.){3}\d{1,3}\b')
+    # headers a proxy adds when it tells the target who is behind it
+    revealing = ('via', 'x-forwarded-for', 'x-real-ip', 'forwarded', 'proxy-connection')
+
+    def syntax(self):
+        return '[options]'
+
+    def short_desc(self):
+        return 'Check proxies concurrently and keep the healthy ones in the proxy table'
+
+    def add_options(self, parser):
+        ScrapyCommand.add_options(self, parser)
+        parser.add_option("-f", "--file", metavar="FILE",
+                          help="read candidate proxies from FILE, one per line (default: PROXY_TABLE)")
+        parser.add_option("-u", "--url", metavar="URL",
+                          help="http url fetched through every proxy, one echoing the request headers "
+                               "also tells the anonymity (default: PROXY_CHECK_URL)")
+        parser.add_option("-c", "--concurrency", type="int", metavar="N",
+                          help="checks running at once (default: PROXY_CHECK_CONCURRENCY)")
+        parser.add_option("-t", "--timeout", type="float", metavar="SECONDS",
+                          help="timeout of one check (default: PROXY_CHECK_TIMEOUT)")
+        parser.add_option("-e", "--expect", metavar="TEXT",
+                          help="a healthy response body contains TEXT, catches captcha and error pages")
+        parser.add_option("--dry-run", action="store_true", default=False,
+                          help="only print the ranking, dont write the proxy table")
+
+    def process_options(self, args, opts):
+        ScrapyCommand.process_options(self, args, opts)
+        if opts.concurrency is not None and opts.concurrency <= 0:
+            raise UsageError("Invalid -c value, must be positive", print_help=False)
+        if opts.timeout is not None and opts.timeout <= 0:
+            raise UsageError("Invalid -t value, must be positive", print_help=False)
+        url = opts.url or self.settings.get('PROXY_CHECK_URL')
+        if not url or urlparse(url).scheme != 'http':
+            raise UsageError("Invalid -u value, must be an http url", print_help=False)
+        opts.url = url
+
+    def run(self, args, opts):
+        self.url = opts.url
+        self.expect = opts.expect
+        self.timeout = opts.timeout or self.settings.getfloat('PROXY_CHECK_TIMEOUT', 5)
+        concurrency = opts.concurrency or self.settings.getint('PROXY_CHECK_CONCURRENCY', 500)
+        self.user_agent = (self.settings.getlist('USER_AGENTS') or [self.settings.get('USER_AGENT')])[0]
+        self.storage = backend_from_settings(self.settings)
+        self.table = self.storage.table(self.settings.get('PROXY_TABLE'))
+        self.results = []
+        try:
+            if opts.file:
+                proxies = self._read_file(opts.file)
+            else:
+                proxies = [r.row for r in self.table.scan(columns=[self.table.column(self.column_family, '0')])]
+            proxies = sorted(set(p for p in (self._normalize(p) for p in proxies) if p))
+            if not proxies:
+                logger.info('No proxy to check.')
+                return
+
+            logger.info('Checking %d proxies against %s, %d at once.', len(proxies), self.url, concurrency)
+            started = time.time()
+            reactor.callWhenRunning(self._check_all, proxies, concurrency)
+            reactor.run(installSignalHandlers=False)
+            elapsed = max(time.time() - started, 0.001)
+
+            healthy = sorted(self.results, key=lambda r: r[1])
+            logger.info('%d of %d proxies healthy, checked in %.1f seconds, %.0f per second.',
+                        len(healthy), len(proxies), elapsed, len(proxies) / elapsed)
+            for rank, (proxy, latency, anonymity) in enumerate(healthy[:20]):
+                logger.info('%3d %-30s %6.3fs %s', rank + 1, proxy, latency, anonymity)
+            if not opts.dry_run:
+                self._write(healthy, proxies if not opts.file else ())
+        except StorageUnavailable as e:
+            logger.error('Proxy table unavailable: %s', e)
+            self.exitcode = 1
+        finally:
+            self.storage.close()
+
+    def _read_file(self, path):
+        with open(path) as f:
+            return [line.strip() for line in f if line.strip() and not line.startswith('#')]
+
+    def _normalize(self, proxy):
+        if '://' not in proxy:
+            proxy = 'http://' + proxy
+        parsed = urlparse(proxy)
+        if parsed.scheme != 'http' or not parsed.hostname or not parsed.port:
+            logger.warning('Skip invalid proxy %s.', proxy)
+            return None
+        return 'http://%s:%d' % (parsed.hostname, parsed.port)
+
+    @defer.inlineCallbacks
+    def _check_all(self, proxies, concurrency):
+        try:
+            # the ips the target sees without a proxy, found again through one means a transparent proxy
+            try:
+                body = yield self._fetch(Agent(reactor, connectTimeout=self.timeout))
+                self.own_ips = set(self.ip_re.findall(body))
+            except Exception as e:
+                logger.warning('Cant fetch %s directly, anonymity unknown: %s', self.url, e)
+                self.own_ips = set()
+            semaphore = defer.DeferredSemaphore(concurrency)
+            yield defer.DeferredList([semaphore.run(self._check, p) for p in proxies])
+        finally:
+            reactor.stop()
+
+    def _fetch(self, agent):
+        d = agent.request('GET', self.url, Headers({'User-Agent': [self.user_agent]}))
+        d.addCallback(self._read)
+        timeout = reactor.callLater(self.timeout, d.cancel)
+
+        def cancel_timeout(result):
+            if timeout.active():
+                timeout.cancel()
+            return result
+
+        d.addBoth(cancel_timeout)
+        return d
+
+    def _read(self, response):
+        if not 200 <= response.code < 300:
+            raise ValueError('status %d' % response.code)
+        return readBody(response)
+
+    @defer.inlineCallbacks
+    def _check(self, proxy):
+        parsed = urlparse(proxy)
+        endpoint = TCP4ClientEndpoint(reactor, parsed.hostname, parsed.port, timeout=self.timeout)
+        started = time.time()
+        try:
+            body = yield self._fetch(ProxyAgent(endpoint))
+        except Exception as e:
+            logger.debug('Proxy %s failed: %s', proxy, e)
+            return
+        latency = time.time() - started
+        if self.expect and self.expect not in body:
+            logger.debug('Proxy %s returned an unexpected page.', proxy)
+            return
+        self.results.append((proxy, latency, self._anonymity(body)))
+
+    def _anonymity(self, body):
+        if not self.own_ips:
+            return 'unknown'
+        if self.own_ips & set(self.ip_re.findall(body)):
+            return 'transparent'
+        lower = body.lower()
+        if any(h in lower for h in self.revealing):
+            return 'anonymous'
+        return 'elite'
+
+    def _write(self, healthy, checked):
+        column_families = (Hbase.ColumnDescriptor(name=self.column_family, maxVersions=1),)
+        self.table.create_table_if_not_exists(column_families)
+        rows = []
+        for rank, (proxy, latency, anonymity) in enumerate(healthy):
+            rows.append(self.table.batch_mutation(proxy, [
+                self.table.mutation(self.column_family, '0', str(rank)),
+                self.table.mutation(self.column_family, 'latency', '%.3f' % latency),
+                self.table.mutation(self.column_family, 'anonymity', anonymity)]))
+        # proxies read from the table that failed are removed from it
+        alive = set(p for p, _, _ in healthy)
+        columns = [self.table.column(self.column_family, q) for q in ('0', 'latency', 'anonymity')]
+        for proxy in checked:
+            if proxy not in alive:
+                rows.append(self.table.batch_mutation(proxy, [Hbase.Mutation(column=c, isDelete=True)
+                                                              for c in columns]))
+        batch_size = max(self.settings.getint('HBASE_BATCH_SIZE', 1), 1)
+        for i in range(0, len(rows), batch_size):
+            self.table.put_rows(rows[i:i + batch_size])
+        logger.info('Wrote %d healthy proxies, removed %d.', len(healthy), len(rows) - len(healthy))
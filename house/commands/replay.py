@@ -0,0 +1,111 @@
+import logging
+import os
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+from scrapy.commands import ScrapyCommand
+from scrapy.exceptions import UsageError
+
+from house.storage import StorageUnavailable, backend_from_settings
+from house.spool import MutationSpool
+
+logger = logging.getLogger(__name__)
+
+
+class Command(ScrapyCommand):
+
+    requires_project = True
+    claimed = '.replaying'
+
+    def syntax(self):
+        return '[options]'
+
+    def short_desc(self):
+        return 'Replay spooled mutations into the storage backend'
+
+    def add_options(self, parser):
+        ScrapyCommand.add_options(self, parser)
+        parser.add_option("-d", "--dir", metavar="DIR",
+                          help="spool directory (default: SPOOL_DIR)")
+        parser.add_option("-c", "--concurrency", type="int", metavar="N",
+                          help="segments replayed in parallel (default: HBASE_POOL_SIZE)")
+        parser.add_option("-b", "--batch-size", type="int", metavar="N",
+                          help="rows per mutateRows call (default: HBASE_BATCH_SIZE)")
+        parser.add_option("--recover", action="store_true", default=False,
+                          help="also replay unfinished and interrupted segments, "
+                               "only when no crawler is writing to the spool")
+
+    def process_options(self, args, opts):
+        ScrapyCommand.process_options(self, args, opts)
+        if opts.concurrency is not None and opts.concurrency <= 0:
+            raise UsageError("Invalid -c value, must be positive", print_help=False)
+        if opts.batch_size is not None and opts.batch_size <= 0:
+            raise UsageError("Invalid -b value, must be positive", print_help=False)
+
+    def run(self, args, opts):
+        directory = opts.dir or self.settings.get('SPOOL_DIR', 'spool')
+        self.batch_size = opts.batch_size or max(self.settings.getint('HBASE_BATCH_SIZE', 1), 1)
+        concurrency = opts.concurrency or self.settings.getint('HBASE_POOL_SIZE', 10)
+        self.storage = backend_from_settings(self.settings)
+        self.lock = threading.Lock()
+        self.progress = {'segments': 0, 'failed': 0, 'rows': 0}
+
+        if opts.recover and os.path.isdir(directory):
+            for path in MutationSpool.segments(directory, 'mutations', partial=True):
+                if path.endswith(MutationSpool.partial):
+                    os.rename(path, path[:-len(MutationSpool.partial)])
+            for name in os.listdir(directory):
+                if name.endswith(self.claimed):
+                    path = os.path.join(directory, name)
+                    os.rename(path, path[:-len(self.claimed)])
+
+        segments = MutationSpool.segments(directory, 'mutations')
+        if not segments:
+            logger.info('No spooled segment in %s.', directory)
+            return
+        logger.info('Replaying %d segments from %s with %d workers.', len(segments), directory, concurrency)
+
+        started = time.time()
+        workers = ThreadPool(concurrency)
+        try:
+            workers.map(self._replay, segments, chunksize=1)
+        finally:
+            workers.close()
+            workers.join()
+            self.storage.close()
+
+        elapsed = max(time.time() - started, 0.001)
+        logger.info('Replayed %(segments)d segments, %(rows)d rows, %(failed)d segments failed', self.progress)
+        logger.info('%.1f rows per second in %.1f seconds.', self.progress['rows'] / elapsed, elapsed)
+        if self.progress['failed']:
+            self.exitcode = 1
+
+    def _replay(self, path):
+        # claiming by rename keeps concurrent replays from writing a segment twice
+        claimed = path + self.claimed
+        try:
+            os.rename(path, claimed)
+        except OSError:
+            return
+
+        rows = 0
+        try:
+            for table, batch_mutations in MutationSpool.read_batches(claimed):
+                for i in range(0, len(batch_mutations), self.batch_size):
+                    batch = batch_mutations[i:i + self.batch_size]
+                    self.storage.table(table).put_rows(batch)
+                    rows += len(batch)
+        except StorageUnavailable as e:
+            os.rename(claimed, path)
+            logger.error('Replay %s stopped after %d rows: %s', path, rows, e)
+            with self.lock:
+                self.progress['failed'] += 1
+            return
+
+        os.remove(claimed)
+        with self.lock:
+            self.progress['segments'] += 1
+            self.progress['rows'] += rows
+            logger.info('Replayed %s, %d rows (%d segments, %d rows done).', os.path.basename(path), rows,
+                        self.progress['segments'], self.progress['rows'])
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import logging
+
+from hbase import Hbase
+from scrapy import signals
+from w3lib.url import canonicalize_url
+
+from house.index import _to_str
+from house.storage import StorageUnavailable, backend_from_crawler
+
+logger = logging.getLogger(__name__)
+
+
+class PageDigestCache(object):
+    # one row per listing page, keyed by md5 of its canonical url, holding a digest of the ids and prices on it
+    column_family = 'cf'
+    qualifier = '0'
+    ttl = 7 * 86400
+
+    def __init__(self, storage, stats=None, flush_size=500):
+        self.storage = storage
+        self.stats = stats
+        self.flush_size = flush_size
+        self.column = storage.column(self.column_family, self.qualifier)
+        self.digests = {}
+        self.unflushed = {}
+        self.pages = 0
+        self.skipped = 0
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        cache = getattr(crawler, 'page_digests', None)
+        if cache is None:
+            table = crawler.settings.get('PAGE_DIGEST_TABLE', 'digest')
+            cache = cls(backend_from_crawler(crawler).table(table), crawler.stats,
+                        flush_size=crawler.settings.getint('PAGE_DIGEST_FLUSH_SIZE', 500))
+            crawler.page_digests = cache
+            crawler.signals.connect(cache.spider_opened, signal=signals.spider_opened)
+            crawler.signals.connect(cache.spider_closed, signal=signals.spider_closed)
+        return cache
+
+    @classmethod
+    def key(cls, url):
+        return hashlib.md5(canonicalize_url(url)).hexdigest()
+
+    @classmethod
+    def digest(cls, rows):
+        m = hashlib.md5()
+        for row in rows:
+            m.update('\x00'.join(_to_str(v) for v in row))
+            m.update('\x01')
+        return m.digest()[:8]
+
+    def spider_opened(self):
+        # the engine waits for the digests before the first page is parsed
+        d = self.storage.backend.defer(self.load)
+        d.addErrback(self._load_failed)
+        return d
+
+    def load(self):
+        column_families = (Hbase.ColumnDescriptor(name=self.column_family, maxVersions=1, timeToLive=self.ttl),)
+        self.storage.create_table_if_not_exists(column_families)
+        digests = {}
+        for r in self.storage.scan(columns=[self.column]):
+            digests[r.row] = r.columns[self.column].value
+        self.digests = digests
+        logger.info('Loaded digests of %d pages.', len(digests))
+
+    def _load_failed(self, failure):
+        failure.trap(StorageUnavailable)
+        logger.warning('Cant load page digests, parse every page: %s', failure.value)
+
+    def unchanged(self, url, digest):
+        self.pages += 1
+        if self.digests.get(self.key(url)) == digest:
+            self.skipped += 1
+            # kept current, IdleSpider counts skipped pages as progress
+            if self.stats:
+                self.stats.inc_value('page_digest/skipped')
+            return True
+        return False
+
+    def record(self, url, digest):
+        # only once every item of the page was emitted, a failed parse is retried next time
+        key = self.key(url)
+        self.digests[key] = digest
+        self.unflushed[key] = digest
+        if len(self.unflushed) >= self.flush_size:
+            self.flush()
+
+    def flush(self):
+        if not self.unflushed:
+            return
+        unflushed, self.unflushed = self.unflushed, {}
+        batch = [self.storage.batch_mutation(k, [self.storage.mutation(self.column_family, self.qualifier, v)])
+                 for k, v in unflushed.items()]
+        d = self.storage.backend.defer(self.storage.put_rows, batch)
+        d.addErrback(self._flush_failed, len(batch))
+        return d
+
+    def _flush_failed(self, failure, count):
+        # those pages are parsed again next time
+        logger.warning('Cant save digests of %d pages: %s', count, failure.getErrorMessage())
+
+    def spider_closed(self):
+        if self.stats:
+            self.stats.set_value('page_digest/pages', self.pages)
+            if self.pages:
+                self.stats.set_value('page_digest/skip_ratio', float(self.skipped) / self.pages)
+        return self.flush()
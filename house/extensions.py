@@ -20,6 +20,7 @@ class IdleSpider(object):
         self.crawler = crawler
         self.checked = time.time()
         self.items = 0
+        self.skipped = 0
 
     @classmethod
     def from_crawler(cls, crawler):
@@ -36,11 +37,15 @@ class IdleSpider(object):
     def request_scheduled(self, spider):
         now = time.time()
         if now - self.checked >= self.timeout:
-            if self.items == 0:
+            # unchanged pages scrape nothing, on a quiet day they are all the progress there is
+            skipped = self.crawler.stats.get_value('page_digest/skipped', 0)
+            if self.items == 0 and skipped == self.skipped:
                 self.crawler.engine.close_spider(spider, 'no item scraped')
             else:
-                spider.log("Scraped %d item in last %d seconds." % (self.items, self.timeout))
+                spider.log("Scraped %d item and skipped %d unchanged pages in last %d seconds."
+                           % (self.items, skipped - self.skipped, self.timeout))
                 self.items = 0
+            self.skipped = skipped
             self.checked = now
 
     def item_scraped(self, item, spider):
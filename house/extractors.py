@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+from lxml import etree
+
+
+def xpath(path):
+    return etree.XPath(path, smart_strings=False)
+
+
+def first(values):
+    return values[0] if values else None
+
+
+def first_text(values):
+    # cards put icons and separators between text nodes, take the first one with content
+    for v in values:
+        if v.strip(u' |\n\t\xa0'):
+            return v
+    return None
+
+
+def all_values(values):
+    return values
+
+
+class CardExtractor(object):
+    # listing cards are found with one query and every field is a compiled xpath relative to its card,
+    # a card missing a field gets None for it instead of shifting the fields of every later card
+    cards = None
+    fields = ()
+
+    def extract(self, sel):
+        root = getattr(sel, 'root', sel)
+        records = []
+        for card in self.cards(root):
+            record = dict((name, pick(path(card))) for name, path, pick in self.fields)
+            records.append(self.finish(record))
+        return records
+
+    def finish(self, record):
+        return record
+
+
+class SecondhandCardExtractor(CardExtractor):
+    cards = xpath('//div[@class="priceInfo"]/ancestor::li[1]')
+    fields = (
+        ('title', xpath('.//div[@class="title"]/a/text()'), first),
+        ('comm', xpath('.//div[@class="address"]/div[@class="houseInfo"]/a/text()'), first),
+        ('info', xpath('.//div[@class="address"]/div[@class="houseInfo"]/text()'), first_text),
+        ('b_year', xpath('.//div[@class="flood"]/div[@class="positionInfo"]/text()'), first_text),
+        ('sub', xpath('.//div[@class="flood"]/div[@class="positionInfo"]/a/text()'), first),
+        ('tags', xpath('.//div[@class="tag"]/span/@class'), all_values),
+        ('total', xpath('.//div[@class="priceInfo"]/div[@class="totalPrice"]/span/text()'), first),
+        ('unit', xpath('.//div[@class="priceInfo"]/div[@class="unitPrice"]/@data-price'), first),
+        ('id', xpath('.//div[@class="priceInfo"]/div[@class="unitPrice"]/@data-hid'), first),
+    )
+
+
+class SoldCardExtractor(CardExtractor):
+    cards = xpath('//ul[@class="listContent"]/li')
+    fields = (
+        ('link', xpath('.//div[@class="title"]/a/@href'), first),
+        ('title', xpath('.//div[@class="title"]/a/text()'), first),
+        ('info', xpath('.//div[@class="address"]/div[@class="houseInfo"]/text()'), first_text),
+        ('deal', xpath('.//div[@class="address"]/div[@class="dealDate"]/text()'), first_text),
+        ('total', xpath('.//div[@class="address"]/div[@class="totalPrice"]/span/text()'), first),
+        ('b_year', xpath('.//div[@class="flood"]/div[@class="positionInfo"]/text()'), first_text),
+        ('unit', xpath('.//div[@class="flood"]/div[@class="unitPrice"]/span/text()'), first),
+        ('hang', xpath('.//div[@class="dealCycleeInfo"]/span[@class="dealCycleTxt"]/span[1]/text()'), first),
+        ('period', xpath('.//div[@class="dealCycleeInfo"]/span[@class="dealCycleTxt"]/span[2]/text()'), first),
+    )
+
+    def finish(self, record):
+        link = record.pop('link')
+        record['id'] = link.split('/')[-1].split('.')[0] if link else None
+        return record
+
+
+secondhand_cards = SecondhandCardExtractor()
+sold_cards = SoldCardExtractor()
+
+
+result_counts = xpath('//*[contains(concat(" ", @class, " "), " total ")]/span/text()')
+# shown once a main area is selected, below the main areas
+sub_area_links = xpath('//div[@data-role="ershoufang"]/div[2]/a')
+
+
+def total_count(sel):
+    # houses the site says match, it only pages through a part of them
+    for value in result_counts(getattr(sel, 'root', sel)):
+        digits = ''.join(c for c in value if c.isdigit())
+        if digits:
+            return int(digits)
+    return None
+
+
+def sub_areas(sel):
+    return [(a.text.strip(), a.get('href')) for a in sub_area_links(getattr(sel, 'root', sel))
+            if a.text and a.get('href')]
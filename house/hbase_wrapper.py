@@ -1,76 +1,231 @@
 # -*- coding: utf-8 -*-
+import logging
+import Queue
+import socket
+import threading
+import time
+
 from hbase import Hbase
 from thrift.protocol import TBinaryProtocol
 from thrift.transport import TTransport, TSocket
 from thrift.transport.TTransport import TFramedTransport, TTransportException
 from hbase.ttypes import IOError
 
+from house.storage import Backend, StorageUnavailable, Table
 
-class HbaseWrapper(object):
-    def __init__(self, host='127.0.0.1', port=9090, table=None):
-        self.host = host
-        self.port = port
-        if not isinstance(table, str):
-            raise TypeError('table must be type str')
-        self.table = table
-        self._create_connection()
+logger = logging.getLogger(__name__)
 
-    def _create_connection(self):
-        self.transport = TTransport.TBufferedTransport(TFramedTransport(TSocket.TSocket(self.host, self.port)))
-        self.protocol = TBinaryProtocol.TBinaryProtocolAccelerated(self.transport)
-        self.client = Hbase.Client(self.protocol)
-        self.transport.open()
 
-    def create_table_if_not_exists(self, column_families):
-            try:
-                self.client.getColumnDescriptors(self.table)
-            except IOError:
-                self.client.createTable(self.table, column_families)
+class HbaseUnavailable(StorageUnavailable):
+    pass
 
-    @classmethod
-    def column(cls, column_family, qualifier):
-        return '%s:%s' % (column_family, qualifier)
 
-    @classmethod
-    def mutation(cls, column_family, qualifier, value=None):
-        return Hbase.Mutation(column=cls.column(column_family, qualifier), value=value)
+class CircuitBreaker(object):
+    def __init__(self, threshold=5, reset_timeout=30):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.lock = threading.Lock()
+
+    @property
+    def is_open(self):
+        return self.opened_at is not None
+
+    def allow(self):
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if time.time() - self.opened_at >= self.reset_timeout:
+                # half open: let this caller probe, keep the others out for another period
+                self.opened_at = time.time()
+                return True
+            return False
+
+    def success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
 
-    def _reopen(self):
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.failures >= self.threshold:
+                if self.opened_at is None:
+                    logger.warning('Circuit breaker opened after %d hbase failures.', self.failures)
+                self.opened_at = time.time()
+
+
+class HbaseConnection(object):
+    def __init__(self, host, port, timeout=None):
+        sock = TSocket.TSocket(host, port)
+        if timeout:
+            sock.setTimeout(timeout * 1000)
+        self.transport = TTransport.TBufferedTransport(TFramedTransport(sock))
+        self.protocol = TBinaryProtocol.TBinaryProtocolAccelerated(self.transport)
+        self.client = Hbase.Client(self.protocol)
+
+    def open(self):
+        if not self.transport.isOpen():
+            self.transport.open()
+
+    def close(self):
         if self.transport.isOpen():
             self.transport.close()
-        self.transport.open()
 
-    def put(self, row_key, mutations, attrs={}):
+
+class HbaseWrapper(Table):
+    def _create_table(self, column_families, split_keys=None):
+        self.backend.execute(self._create_table_if_not_exists, column_families, split_keys)
+
+    def _create_table_if_not_exists(self, client, column_families, split_keys):
         try:
-            self.client.mutateRow(self.table, row_key, mutations, attrs)
-        except TTransportException:
-            self._reopen()
-            self.put(row_key, mutations, attrs)
+            client.getColumnDescriptors(self.table)
+        except IOError:
+            client.createTable(self.table, column_families)
+            if split_keys:
+                # the thrift gateway has no split call, regions for salted keys are split by the shell
+                logger.warning('Created table %s with one region, pre-split it with: %s',
+                               self.table, self.split_command(split_keys))
+
+    def split_command(self, split_keys):
+        return '; '.join("split '%s', '%s'" % (self.table, key) for key in split_keys)
+
+    def put(self, row_key, mutations, attrs={}):
+        self.backend.execute(lambda client: client.mutateRow(self.table, row_key, mutations, attrs))
+
+    def put_rows(self, batch_mutations, attrs={}):
+        self.backend.execute(lambda client: client.mutateRows(self.table, batch_mutations, attrs))
 
     def get(self, row_key, columns, attrs={}):
-        try:
-            return self.client.getRowWithColumns(self.table, row_key, columns, attrs)
-        except TTransportException:
-            self._reopen()
-            return self.get(row_key, columns, attrs)
+        return self.backend.execute(lambda client: client.getRowWithColumns(self.table, row_key, columns, attrs))
+
+    def get_rows(self, row_keys, columns, attrs={}):
+        return self.backend.execute(lambda client: client.getRowsWithColumns(self.table, row_keys, columns, attrs))
 
     def delete(self, row_key):
+        self.backend.execute(lambda client: client.deleteAllRow(self.table, row_key, {}))
+
+    def check_and_put(self, row_key, column, value, mutation, attrs={}):
+        return self.backend.execute(
+            lambda client: client.checkAndPut(self.table, row_key, column, value, mutation, attrs))
+
+    def scan(self, start_row='', stop_row=None, prefix=None, columns=None, row_regex=None, batch_size=None):
+        start_row, stop_row, batch_size = self._scan_range(start_row, stop_row, prefix, batch_size)
+        filter_string = "RowFilter(=, 'regexstring:%s')" % row_regex if row_regex else None
+        tscan = Hbase.TScan(startRow=start_row, stopRow=stop_row, columns=columns,
+                            caching=batch_size, filterString=filter_string)
+        scan_id = self.backend.execute(lambda client: client.scannerOpenWithScan(self.table, tscan, {}))
+        reopens = 0
         try:
-            self.client.deleteAllRow(self.table, row_key, {})
-        except TTransportException:
-            self._reopen()
-            return self.delete(row_key)
+            while True:
+                try:
+                    # a retry would read on from wherever the failed call left the scanner
+                    rows = self.backend.execute(lambda client: client.scannerGetList(scan_id, batch_size),
+                                                retry=False)
+                except HbaseUnavailable:
+                    if reopens >= self.backend.retry_times:
+                        raise
+                    reopens += 1
+                    logger.debug('Scan of %s failed, reopen it at %r.', self.table, tscan.startRow)
+                    self._close_scanner(scan_id)
+                    scan_id = self.backend.execute(lambda client: client.scannerOpenWithScan(self.table, tscan, {}))
+                    continue
+                if not rows:
+                    return
+                reopens = 0
+                for row in rows:
+                    yield row
+                # the smallest key after the last row returned
+                tscan.startRow = rows[-1].row + '\x00'
+        finally:
+            self._close_scanner(scan_id)
 
-    def scan_and_get(self, tscan, num=100):
+    def _close_scanner(self, scan_id):
         try:
-            scan_id = self.client.scannerOpenWithScan(self.table, tscan, {})
-            rows = self.client.scannerGetList(scan_id, num)
-            self.client.scannerClose(scan_id)
-            return [r.row for r in rows]
-        except TTransportException:
-            self._reopen()
-            return self.scan_and_get(tscan, num)
+            self.backend.execute(lambda client: client.scannerClose(scan_id), retry=False)
+        except HbaseUnavailable:
+            # the gateway drops the scanner once its lease expires
+            pass
+
+
+class HbasePool(Backend):
+    table_class = HbaseWrapper
+
+    def __init__(self, host='127.0.0.1', port=9090, size=10, timeout=None,
+                 retry_times=5, retry_delay=0.5, max_retry_delay=10,
+                 breaker_threshold=5, breaker_timeout=30, max_inflight=100, scan_batch_size=1000,
+                 salt_buckets=None, stats=None):
+        super(HbasePool, self).__init__(size, max_inflight, scan_batch_size, salt_buckets, stats)
+        self.host = host
+        self.port = port
+        self.retry_times = retry_times
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.breaker = CircuitBreaker(breaker_threshold, breaker_timeout)
+        # connections are only opened when a caller first needs them
+        self.connections = Queue.LifoQueue(size)
+        for _ in range(size):
+            self.connections.put(HbaseConnection(host, port, timeout))
+
+    @classmethod
+    def from_settings(cls, settings, stats=None):
+        return cls(
+            host=settings.get('HBASE_HOST', 'localhost'),
+            port=settings.getint('HBASE_PORT', 9090),
+            size=settings.getint('HBASE_POOL_SIZE', 10),
+            timeout=settings.getfloat('HBASE_TIMEOUT', 0),
+            retry_times=settings.getint('HBASE_RETRY_TIMES', 5),
+            retry_delay=settings.getfloat('HBASE_RETRY_DELAY', 0.5),
+            max_retry_delay=settings.getfloat('HBASE_MAX_RETRY_DELAY', 10),
+            breaker_threshold=settings.getint('HBASE_BREAKER_THRESHOLD', 5),
+            breaker_timeout=settings.getfloat('HBASE_BREAKER_TIMEOUT', 30),
+            max_inflight=settings.getint('STORAGE_MAX_INFLIGHT', 100),
+            scan_batch_size=settings.getint('STORAGE_SCAN_BATCH_SIZE', 1000),
+            salt_buckets=settings.getdict('STORAGE_SALT_BUCKETS'),
+            stats=stats
+        )
+
+    def _inc_stats(self, key):
+        if self.stats:
+            self.stats.inc_value('hbase/%s' % key)
+
+    def execute(self, func, *args, **kwargs):
+        # retry=False for calls that are not safe to repeat
+        retry_times = self.retry_times if kwargs.get('retry', True) else 0
+        delay = self.retry_delay
+        error = None
+        for attempt in range(retry_times + 1):
+            if not self.breaker.allow():
+                self._inc_stats('rejected')
+                raise HbaseUnavailable('circuit breaker open for %s:%s' % (self.host, self.port))
+
+            connection = self.connections.get()
+            try:
+                connection.open()
+                result = func(connection.client, *args)
+            except (TTransportException, socket.error) as e:
+                connection.close()
+                self.breaker.failure()
+                self._inc_stats('failures')
+                error = e
+            else:
+                self.breaker.success()
+                return result
+            finally:
+                self.connections.put(connection)
+
+            if attempt < retry_times and not self.breaker.is_open:
+                logger.debug('Hbase call failed: %s, retry in %.1f seconds.', error, delay)
+                time.sleep(delay)
+                delay = min(delay * 2, self.max_retry_delay)
+
+        raise HbaseUnavailable('%s:%s unreachable: %s' % (self.host, self.port, error))
 
     def close(self):
-        if self.transport.isOpen():
-            self.transport.close()
+        super(HbasePool, self).close()
+        # a lifo queue hands back the connection put last, so every one is taken out before any goes back
+        connections = [self.connections.get() for _ in range(self.size)]
+        for connection in connections:
+            connection.close()
+            self.connections.put(connection)
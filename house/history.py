@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import logging
+
+from hbase import Hbase
+from scrapy import signals
+from twisted.internet import defer, reactor, task
+
+from house.bloom import ScalableBloomFilter
+from house.spool import MutationSpool
+from house.storage import StorageUnavailable, backend_from_crawler
+
+logger = logging.getLogger(__name__)
+
+
+class CrawlHistory(object):
+    column_family = 'cf'
+    qualifier = '0'
+    # rows expire after a day, so the table only holds today's pages
+    ttl = 86400
+
+    def __init__(self, storage, bloom=None, stats=None, max_unflushed=1000, flush_interval=5, spool=None):
+        self.storage = storage
+        self.bloom = bloom
+        self.stats = stats
+        # at most max_unflushed fingerprints are lost on a crash
+        self.max_unflushed = max_unflushed
+        self.flush_interval = flush_interval
+        self.spool = spool
+        self.unflushed = set()
+        # flush deferred -> row keys it writes
+        self.flushing = {}
+        self.flush_task = None
+        # row key -> deferreds waiting for the next batch lookup
+        self.pending = {}
+        self.lookup_call = None
+        self.columns = (self.storage.column(self.column_family, self.qualifier),)
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        history = getattr(crawler, 'crawl_history', None)
+        if history is None:
+            settings = crawler.settings
+            bloom = None
+            if settings.getbool('HISTORY_BLOOM_ENABLED', True):
+                bloom = ScalableBloomFilter(settings.getint('HISTORY_BLOOM_CAPACITY', 100000),
+                                            settings.getfloat('HISTORY_BLOOM_ERROR_RATE', 0.001))
+            table = settings.get('HISTORY_TABLE')
+            history = cls(backend_from_crawler(crawler).table(table), bloom, crawler.stats,
+                          max_unflushed=settings.getint('HISTORY_MAX_UNFLUSHED', 1000),
+                          flush_interval=settings.getfloat('HISTORY_FLUSH_INTERVAL', 5),
+                          spool=MutationSpool.from_crawler(crawler) if settings.getbool('SPOOL_ENABLED') else None)
+            crawler.crawl_history = history
+            crawler.signals.connect(history.spider_opened, signal=signals.spider_opened)
+            crawler.signals.connect(history.spider_closed, signal=signals.spider_closed)
+        return history
+
+    @classmethod
+    def fingerprint(cls, url, suffix=None):
+        m = hashlib.md5(url)
+        if suffix:
+            m.update(suffix)
+        return m.hexdigest()
+
+    @classmethod
+    def request_fingerprint(cls, request):
+        return cls.fingerprint(request.url, request.meta.get('suffix'))
+
+    def spider_opened(self):
+        if self.flush_interval > 0:
+            self.flush_task = task.LoopingCall(self.flush)
+            self.flush_task.start(self.flush_interval, now=False)
+        # the engine waits for this, no request is checked against a missing table or a half loaded filter
+        d = self.storage.backend.defer(self.load)
+        d.addErrback(self._load_failed)
+        return d
+
+    def load(self):
+        column_families = (Hbase.ColumnDescriptor(name=self.column_family, maxVersions=1, timeToLive=self.ttl),)
+        self.storage.create_table_if_not_exists(column_families)
+        if self.bloom is None:
+            return
+        bloom = ScalableBloomFilter(self.bloom.initial_capacity, self.bloom.error_rate)
+        for r in self.storage.scan(columns=self.columns):
+            bloom.add(r.row)
+        self.bloom = bloom
+        logger.info('Loaded %d history rows into bloom filter, %d bytes.', len(bloom), bloom.memory)
+        self._set_bloom_stats()
+
+    def _load_failed(self, failure):
+        failure.trap(StorageUnavailable)
+        logger.warning('Cant load history, checking every request against storage: %s', failure.value)
+        self.bloom = None
+
+    def maybe_crawled(self, row_key):
+        if self.bloom is None:
+            return True
+        if self.stats:
+            self.stats.inc_value('history/bloom/checks')
+        return row_key in self.bloom
+
+    def is_crawled(self, row_key):
+        # pages recorded this run but not written yet are answered here, storage would miss them
+        if row_key in self.unflushed or any(row_key in keys for keys in self.flushing.values()):
+            return defer.succeed(True)
+        # the keys asked for in one reactor turn, a pagination fan-out reaching the downloader,
+        # are read with one multi row read in the storage threads
+        d = defer.Deferred()
+        self.pending.setdefault(row_key, []).append(d)
+        if self.lookup_call is None:
+            self.lookup_call = reactor.callLater(0, self._lookup)
+        return d
+
+    def _lookup(self):
+        self.lookup_call = None
+        pending, self.pending = self.pending, {}
+        d = self.storage.backend.defer(self.storage.get_rows, list(pending), self.columns)
+        d.addCallbacks(self._looked_up, self._lookup_failed, callbackArgs=(pending,), errbackArgs=(pending,))
+
+    def _looked_up(self, rows, pending):
+        crawled = set(r.row for r in rows)
+        if self.stats:
+            self.stats.inc_value('history/batch_lookups')
+            self.stats.inc_value('history/batch_rows', len(pending))
+        for row_key, waiting in pending.items():
+            for d in waiting:
+                d.callback(row_key in crawled)
+
+    def _lookup_failed(self, failure, pending):
+        if failure.check(StorageUnavailable):
+            logger.warning('Cant check history of %d pages: %s', len(pending), failure.getErrorMessage())
+        for waiting in pending.values():
+            for d in waiting:
+                if failure.check(StorageUnavailable):
+                    d.callback(False)
+                else:
+                    d.errback(failure)
+
+    def checked(self, crawled):
+        # called in the reactor with the storage answer to a bloom positive
+        if self.stats and self.bloom is not None:
+            self.stats.inc_value('history/bloom/positives')
+            if not crawled:
+                self.stats.inc_value('history/bloom/false_positives')
+        return crawled
+
+    def add(self, row_key):
+        if self.bloom is not None:
+            self.bloom.add(row_key)
+
+    def record(self, row_key):
+        self.add(row_key)
+        self.unflushed.add(row_key)
+        if len(self.unflushed) >= self.max_unflushed:
+            self.flush()
+
+    def flush(self):
+        if not self.unflushed:
+            return defer.succeed(None)
+        row_keys, self.unflushed = self.unflushed, set()
+        mutations = (self.storage.mutation(self.column_family, self.qualifier),)
+        batch = [self.storage.batch_mutation(k, mutations) for k in sorted(row_keys)]
+        d = self.storage.backend.defer(self.storage.put_rows, batch)
+        d.addCallbacks(self._flushed, self._flush_failed, callbackArgs=(batch,), errbackArgs=(batch,))
+        self.flushing[d] = row_keys
+        d.addBoth(self._done, d)
+        return d
+
+    def _flushed(self, result, batch):
+        if self.stats:
+            self.stats.inc_value('history/flush_count')
+            self.stats.inc_value('history/recorded', len(batch))
+
+    def _flush_failed(self, failure, batch):
+        if self.spool and failure.check(StorageUnavailable):
+            logger.warning('Spool %d history rows: %s', len(batch), failure.getErrorMessage())
+            self.spool.write_batch(self.storage.table, batch)
+            return
+        logger.warning('Cant record %d history rows: %s', len(batch), failure.getErrorMessage())
+        if self.stats:
+            self.stats.inc_value('history/lost_rows', len(batch))
+
+    def _done(self, result, d):
+        self.flushing.pop(d, None)
+        return result
+
+    def _set_bloom_stats(self):
+        if self.stats and self.bloom is not None:
+            self.stats.set_value('history/bloom/items', len(self.bloom))
+            self.stats.set_value('history/bloom/memory', self.bloom.memory)
+
+    def spider_closed(self):
+        if self.flush_task and self.flush_task.running:
+            self.flush_task.stop()
+        self.flush()
+        self._update_stats()
+        return defer.DeferredList(list(self.flushing))
+
+    def _update_stats(self):
+        if self.stats and self.bloom is not None:
+            self._set_bloom_stats()
+            false_positives = self.stats.get_value('history/bloom/false_positives', 0)
+            crawled = self.stats.get_value('history/bloom/positives', 0) - false_positives
+            # share of the not crawled pages the filter still sent to storage
+            negatives = self.stats.get_value('history/bloom/checks', 0) - crawled
+            if negatives > 0:
+                self.stats.set_value('history/bloom/false_positive_rate', float(false_positives) / negatives)
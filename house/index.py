@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import logging
+
+from scrapy import signals
+
+from house.storage import backend_from_crawler
+
+logger = logging.getLogger(__name__)
+
+
+def _to_str(value):
+    if value is None:
+        return ''
+    return value.encode('utf-8') if isinstance(value, unicode) else str(value)
+
+
+class LastSeenIndex(object):
+    cf_basic = 'basic'
+    cf_price = 'price'
+    basic_qualifiers = ('city', 'title', 'room',
+                        'comm', 'id', 'main',
+                        'sub', 'space', 'tags', 'b_year')
+    price_qualifiers = ('total', 'unit')
+    # history rows are keyed id-reversed_day, only the latest row per house has no dash
+    row_regex = '^[^-]+$'
+
+    def __init__(self, storage, stats=None):
+        self.storage = storage
+        self.stats = stats
+        # house id -> (total, unit, digest of basic columns)
+        self.houses = {}
+        self.seen = set()
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        index = getattr(crawler, 'last_seen_index', None)
+        if index is None:
+            table = crawler.settings.get('SECONDHAND_HOUSE_TABLE')
+            index = cls(backend_from_crawler(crawler).table(table), crawler.stats)
+            crawler.last_seen_index = index
+            crawler.signals.connect(index.spider_closed, signal=signals.spider_closed)
+        return index
+
+    @classmethod
+    def digest(cls, values):
+        return hashlib.md5('\x00'.join(_to_str(v) for v in values)).digest()[:8]
+
+    def load(self):
+        columns = [self.storage.column(self.cf_basic, q) for q in self.basic_qualifiers] + \
+                  [self.storage.column(self.cf_price, q) for q in self.price_qualifiers]
+        houses = {}
+        for r in self.storage.scan(columns=columns, row_regex=self.row_regex):
+            cells = r.columns
+            values = [cells.get(c) for c in columns]
+            values = [v.value if v is not None else None for v in values]
+            n = len(self.basic_qualifiers)
+            houses[r.row] = (values[n], values[n + 1], self.digest(values[:n]))
+        self.houses = houses
+        logger.info('Loaded last seen prices of %d houses.', len(houses))
+        if self.stats:
+            self.stats.set_value('last_seen/houses', len(houses))
+
+    def first_seen(self, house_id):
+        if house_id in self.seen:
+            return False
+        self.seen.add(house_id)
+        return True
+
+    def unchanged(self, house_id, total, unit):
+        old = self.houses.get(house_id)
+        return old is not None and (_to_str(old[0]), _to_str(old[1])) == (_to_str(total), _to_str(unit))
+
+    def update(self, house_id, total, unit, basic_values):
+        digest = self.digest(basic_values)
+        old = self.houses.get(house_id)
+        self.houses[house_id] = (_to_str(total), _to_str(unit), digest)
+        if old is None:
+            return True, True
+        return old[2] != digest, (_to_str(old[0]), _to_str(old[1])) != (_to_str(total), _to_str(unit))
+
+    def spider_closed(self):
+        self.seen.clear()
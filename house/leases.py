@@ -0,0 +1,273 @@
+# -*- coding: utf-8 -*-
+import datetime
+import logging
+import os
+import socket
+import time
+from collections import OrderedDict
+
+from hbase import Hbase
+from scrapy import signals
+from scrapy.exceptions import DontCloseSpider
+from twisted.internet import defer, task
+
+from house.storage import StorageUnavailable, backend_from_crawler
+
+logger = logging.getLogger(__name__)
+
+
+class AreaLeases(object):
+    # one row per day, city, type and main area, the lease column holds owner|expires.
+    # every change is a check_and_put against the value last read, so two nodes never hold one area
+    column_family = 'cf'
+    qualifier = 'lease'
+    done = 'done'
+
+    def __init__(self, storage, node_id, ttl=300, max_areas=4, stats=None):
+        self.storage = storage
+        self.node_id = node_id
+        self.ttl = ttl
+        self.max_areas = max_areas
+        self.stats = stats
+        self.column = storage.column(self.column_family, self.qualifier)
+        self.day = datetime.datetime.now().strftime('%y%m%d')
+        self.crawler = None
+        self.spider = None
+        # area key -> lease value as stored, needed to renew or release it
+        self.held = {}
+        # area key -> urls of its requests still in the engine
+        self.outstanding = {}
+        # area key -> first request of areas leased by someone else
+        self.waiting = OrderedDict()
+        # waiting areas seen leased by other nodes, skipped until every waiting area was tried
+        self.taken = set()
+        self.busy = False
+        # areas came in while a lease round was running, another round follows it
+        self.again = False
+        self.renew_task = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        leases = getattr(crawler, 'area_leases', None)
+        if leases is None:
+            settings = crawler.settings
+            node_id = settings.get('FRONTIER_NODE_ID') or '%s-%d' % (socket.gethostname(), os.getpid())
+            leases = cls(backend_from_crawler(crawler).table(settings.get('LEASE_TABLE', 'lease')), node_id,
+                         ttl=settings.getint('LEASE_TTL', 300),
+                         max_areas=settings.getint('LEASE_MAX_AREAS', 4),
+                         stats=crawler.stats)
+            leases.crawler = crawler
+            crawler.area_leases = leases
+            crawler.signals.connect(leases.spider_opened, signal=signals.spider_opened)
+            crawler.signals.connect(leases.spider_idle, signal=signals.spider_idle)
+            crawler.signals.connect(leases.spider_closed, signal=signals.spider_closed)
+            crawler.signals.connect(leases.request_scheduled, signal=signals.request_scheduled)
+            crawler.signals.connect(leases.request_dropped, signal=signals.request_dropped)
+        return leases
+
+    def key(self, city, kind, area):
+        key = u'%s-%s-%s-%s' % (self.day, city, kind, area)
+        return key.encode('utf-8')
+
+    def _value(self):
+        return '%s|%d' % (self.node_id, time.time() + self.ttl)
+
+    def _inc_stats(self, key, count=1):
+        if self.stats:
+            self.stats.inc_value('leases/%s' % key, count)
+
+    def _read(self, keys):
+        rows = self.storage.get_rows(keys, [self.column])
+        current = dict((k, None) for k in keys)
+        for r in rows:
+            if self.column in r.columns:
+                current[r.row] = r.columns[self.column].value
+        return current
+
+    def _free(self, value):
+        if value is None:
+            return True
+        owner, expires = value.split('|', 1)
+        return owner != self.done and (owner == self.node_id or int(expires) < time.time())
+
+    def _acquire(self, keys, room):
+        # tries the keys in order until room leases are won. returns the leases won, the areas finished
+        # by other nodes and the ones they hold
+        won, finished, taken = {}, [], []
+        current = self._read(keys)
+        for key in keys:
+            value = current[key]
+            if value is not None and value.startswith(self.done + '|'):
+                finished.append(key)
+                continue
+            if len(won) >= room:
+                continue
+            if not self._free(value):
+                taken.append(key)
+                continue
+            new = self._value()
+            if self.storage.check_and_put(key, self.column, value, self.storage.mutation(self.column_family,
+                                                                                           self.qualifier, new)):
+                won[key] = new
+            else:
+                taken.append(key)
+        return won, finished, taken
+
+    def claim(self, requests):
+        # requests carry their area key in meta['area_lease']. they wait here, leases are won in the
+        # storage threads and the engine gets the request of every area won
+        for r in requests:
+            self.waiting.setdefault(r.meta['area_lease'], r)
+        self._take_waiting()
+
+    def _hold(self, key, value):
+        self.held[key] = value
+        self.outstanding[key] = set()
+        logger.info('Leased area %s.', key)
+
+    def _release(self, key, value, done=True):
+        new = '%s|%s' % (self.done, self.node_id) if done else '|0'
+        try:
+            return self.storage.check_and_put(key, self.column, value,
+                                              self.storage.mutation(self.column_family, self.qualifier, new))
+        except StorageUnavailable as e:
+            # the lease expires on its own
+            logger.warning('Cant release area %s: %s', key, e)
+            return False
+
+    def request_scheduled(self, request, spider):
+        key = request.meta.get('area_lease')
+        if key in self.outstanding:
+            self.outstanding[key].add(request.url)
+
+    def request_dropped(self, request, spider):
+        self.finished(request)
+
+    def finished(self, request):
+        # called once a request was processed, redirected urls were scheduled under their old url
+        key = request.meta.get('area_lease')
+        urls = self.outstanding.get(key)
+        if urls is None:
+            return
+        urls.discard(request.url)
+        for url in request.meta.get('redirect_urls', ()):
+            urls.discard(url)
+        if not urls:
+            self._complete(key)
+
+    def _complete(self, key):
+        value = self.held.pop(key)
+        del self.outstanding[key]
+        logger.info('Finished area %s.', key)
+        self._inc_stats('finished')
+        d = self.storage.backend.defer(self._release, key, value)
+        d.addCallback(lambda _: self._take_waiting())
+
+    def _take_waiting(self):
+        if self.busy:
+            self.again = True
+            return
+        room = self.max_areas - len(self.held)
+        if room <= 0 or not self.waiting or self.spider is None:
+            return
+        # areas other nodes hold are tried again once the rest of the queue was
+        keys = [k for k in self.waiting if k not in self.taken]
+        if not keys:
+            self.taken.clear()
+            keys = list(self.waiting)
+        self.busy = True
+        d = self.storage.backend.defer(self._acquire, keys, room)
+        d.addCallbacks(self._took, self._take_failed)
+
+    def _took(self, result):
+        self.busy = False
+        won, finished, taken = result
+        for key in finished:
+            self.waiting.pop(key, None)
+            self.taken.discard(key)
+        self.taken.update(taken)
+        # in the order the areas were claimed
+        for key in [k for k in self.waiting if k in won]:
+            self._hold(key, won[key])
+            self._inc_stats('acquired')
+            self.taken.discard(key)
+            self.crawler.engine.crawl(self.waiting.pop(key), self.spider)
+        if self.again:
+            self.again = False
+            self._take_waiting()
+
+    def _take_failed(self, failure):
+        self.busy = False
+        self.again = False
+        if not failure.check(StorageUnavailable):
+            logger.warning('Cant lease waiting areas: %s', failure.getErrorMessage())
+            return
+        # without storage no node can lease, every area is crawled as if leases were off
+        logger.warning('Cant lease areas, crawl them all: %s', failure.getErrorMessage())
+        waiting, self.waiting = self.waiting, OrderedDict()
+        for request in waiting.values():
+            self.crawler.engine.crawl(request, self.spider)
+
+    def _renew(self, held):
+        renewed, lost = {}, []
+        for key, value in held.items():
+            new = self._value()
+            try:
+                ok = self.storage.check_and_put(key, self.column, value,
+                                                self.storage.mutation(self.column_family, self.qualifier, new))
+            except StorageUnavailable as e:
+                logger.warning('Cant renew area %s: %s', key, e)
+                continue
+            if ok:
+                renewed[key] = new
+            else:
+                lost.append(key)
+        return renewed, lost
+
+    def _renewed(self, result):
+        renewed, lost = result
+        for key, value in renewed.items():
+            if key in self.held:
+                self.held[key] = value
+        for key in lost:
+            if self.held.pop(key, None) is not None:
+                # another node took it after our lease expired, it crawls the area from now on
+                logger.warning('Lost lease of area %s.', key)
+                self.outstanding.pop(key, None)
+                self._inc_stats('lost')
+
+    def renew(self):
+        if not self.held:
+            return
+        d = self.storage.backend.defer(self._renew, dict(self.held))
+        d.addCallback(self._renewed)
+        return d
+
+    def spider_opened(self, spider):
+        self.spider = spider
+        self.renew_task = task.LoopingCall(self.renew)
+        self.renew_task.start(max(self.ttl / 3.0, 1), now=False)
+        column_families = (Hbase.ColumnDescriptor(name=self.column_family, maxVersions=1, timeToLive=2 * 86400),)
+        d = self.storage.backend.defer(self.storage.create_table_if_not_exists, column_families)
+        d.addErrback(self._bootstrap_failed)
+        return d
+
+    def _bootstrap_failed(self, failure):
+        failure.trap(StorageUnavailable)
+        logger.warning('Cant create lease table: %s', failure.value)
+
+    def spider_idle(self, spider):
+        # nothing is left in the engine, so every held area is done
+        for key in list(self.held):
+            self._complete(key)
+        self._take_waiting()
+        if self.waiting or self.held or self.busy:
+            raise DontCloseSpider
+
+    def spider_closed(self, spider):
+        if self.renew_task and self.renew_task.running:
+            self.renew_task.stop()
+        # unfinished areas are handed to the other nodes right away
+        held, self.held = self.held, {}
+        return defer.DeferredList([self.storage.backend.defer(self._release, key, value, False)
+                                   for key, value in held.items()])
@@ -2,7 +2,11 @@ import re
 import sys
 
 from scrapy.loader import ItemLoader
-from scrapy.loader.processors import TakeFirst, MapCompose, Join
+from scrapy.loader.processors import Identity, TakeFirst, MapCompose, Join
+from scrapy.utils.misc import arg_to_iter
+from scrapy.utils.python import get_func_args
+
+from house.items import SecondhandHouseItem, NewHouseItem, SoldHouseItem
 
 reload(sys)
 sys.setdefaultencoding("utf-8")
@@ -88,3 +92,76 @@ class NewHouseLoader(ItemLoader):
     b_space_in = MapCompose(filter_space, encode_field)
     p_year_in = MapCompose(filter_digit, encode_field)
 
+
+def map_values(functions, values):
+    # what MapCompose does, without resolving the loader context on every call
+    for f in functions:
+        next_values = []
+        for v in values:
+            next_values += arg_to_iter(f(v))
+        values = next_values
+    return values
+
+
+def map_value(functions, value):
+    if not isinstance(value, basestring):
+        return map_values(functions, arg_to_iter(value))
+    for i, f in enumerate(functions):
+        value = f(value)
+        if not isinstance(value, basestring):
+            return map_values(functions[i + 1:], arg_to_iter(value))
+    return [value]
+
+
+def take_first(values):
+    for v in values:
+        if v is not None and v != '':
+            return v
+
+
+class ItemNormalizer(object):
+    # the processors a loader class declares are resolved once per field, an item is then filled
+    # in one call with the values a loader gives after one add_value per field and load_item
+    def __init__(self, loader_class, item_class):
+        loader = loader_class(item=item_class())
+        self.item_class = item_class
+        self.fields = {}
+        for name in item_class.fields:
+            self.fields[name] = (self._input(name, loader.get_input_processor(name)),
+                                 self._output(name, loader.get_output_processor(name)))
+
+    def _input(self, name, proc):
+        if isinstance(proc, Identity):
+            return ()
+        if isinstance(proc, MapCompose) and not proc.default_loader_context \
+                and not any('loader_context' in get_func_args(f) for f in proc.functions):
+            return proc.functions
+        raise ValueError('Cant compile input processor of field %s: %r' % (name, proc))
+
+    def _output(self, name, proc):
+        if isinstance(proc, Identity):
+            return list
+        if isinstance(proc, TakeFirst):
+            return take_first
+        if isinstance(proc, Join):
+            return proc.separator.join
+        raise ValueError('Cant compile output processor of field %s: %r' % (name, proc))
+
+    def __call__(self, **values):
+        item = self.item_class()
+        fields = self.fields
+        for name, value in values.iteritems():
+            if value is None:
+                continue
+            functions, output = fields[name]
+            value = map_value(functions, value)
+            if value:
+                value = output(value)
+                if value is not None:
+                    item[name] = value
+        return item
+
+
+normalize_secondhand = ItemNormalizer(SecondhandHouseLoader, SecondhandHouseItem)
+normalize_sold = ItemNormalizer(SoldHouseLoader, SoldHouseItem)
+normalize_new = ItemNormalizer(NewHouseLoader, NewHouseItem)
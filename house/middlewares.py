@@ -4,19 +4,27 @@
 #
 # See documentation in:
 # http://doc.scrapy.org/en/latest/topics/spider-middleware.html
-import hashlib
+import json
+import logging
+import os
 import threading
 from random import Random
 
 import time
 
-import thread
-from hbase import Hbase
 from scrapy import signals
+from twisted.internet import defer, task
+from twisted.internet.error import TimeoutError
+from scrapy.core.downloader import Slot
 from scrapy.exceptions import IgnoreRequest, NotConfigured
 from w3lib.url import safe_url_string
 
-from house.hbase_wrapper import HbaseWrapper
+from house.history import CrawlHistory
+from house.leases import AreaLeases
+from house.proxies import ProxyPool
+from house.storage import backend_from_crawler
+
+logger = logging.getLogger(__name__)
 
 
 class RandomUserAgentMiddleware(object):
@@ -41,63 +49,141 @@ class RandomUserAgentMiddleware(object):
 
 
 class RandomHttpProxyMiddleware(object):
-    r = Random()
-
-    @classmethod
-    def _get_proxies(cls):
-        try:
-            cls.mutex.acquire()
-            cls.http_proxies = cls.hbase.scan_and_get(cls.tscan)
-        finally:
-            cls.mutex.release()
-        cls.checked = time.time()
+    def __init__(self, crawler, pool, storage, timeout, cache_file=None):
+        self.crawler = crawler
+        self.stats = crawler.stats
+        settings = crawler.settings
+        # each proxy is its own downloader slot, the site limits per source ip
+        self.proxy_slots = settings.getbool('PROXY_SLOTS_ENABLED')
+        self.slot_concurrency = settings.getint('PROXY_CONCURRENCY', settings.getint('CONCURRENT_REQUESTS_PER_DOMAIN'))
+        self.slot_delay = settings.getfloat('PROXY_DOWNLOAD_DELAY', settings.getfloat('DOWNLOAD_DELAY'))
+        self.randomize_delay = settings.getbool('RANDOMIZE_DOWNLOAD_DELAY')
+        self.pool = pool
+        self.pool.on_drop = self.remove_proxy
+        self.storage = storage
+        self.timeout = timeout
+        self.cache_file = cache_file
+        self.columns = ['cf:0']
+        self.refresh_task = None
+        self.refreshing = None
+        # requests that came before the first proxy list
+        self.waiting = []
 
     @classmethod
     def from_crawler(cls, crawler):
         # cls.http_proxies = crawler.settings.get('HTTP_PROXIES', False)
         # if not cls.http_proxies:
         #     raise NotConfigured
-        host = crawler.settings.get('HBASE_HOST')
-        port = crawler.settings.get('HBASE_PORT')
         table = crawler.settings.get('PROXY_TABLE')
-        # cls.stats = crawler.stats
-        cls.hbase = HbaseWrapper(host, port, table)
-        cls.mutex = thread.allocate_lock()
-        cls.timeout = crawler.settings.get('PROXIES_TIMEOUT')
-        cls.tscan = Hbase.TScan(columns=['cf:0'], caching=True, batchSize=20)
-        cls._get_proxies()
-        s = cls()
+        s = cls(crawler, ProxyPool.from_crawler(crawler), backend_from_crawler(crawler).table(table),
+                crawler.settings.getint('PROXIES_TIMEOUT'), crawler.settings.get('PROXY_CACHE_FILE'))
+        s._load_cache()
+        crawler.signals.connect(s.spider_opened, signal=signals.spider_opened)
         crawler.signals.connect(s.spider_closed, signal=signals.spider_closed)
         return s
 
-    @classmethod
-    def remove_proxy(cls, proxy):
+    def _load_cache(self):
+        if not self.cache_file or not os.path.exists(self.cache_file):
+            return
         try:
-            cls.mutex.acquire()
-            if proxy in cls.http_proxies:
-                cls.http_proxies.remove(proxy)
-                cls.hbase.delete(proxy)
-        finally:
-            cls.mutex.release()
-        if not cls.http_proxies:
-            return 'proxy list empty'
+            with open(self.cache_file) as f:
+                proxies = json.load(f)
+        except (IOError, ValueError) as e:
+            logger.warning('Cant read proxy cache %s: %s', self.cache_file, e)
+            return
+        self.pool.replace(p.encode('utf-8') for p in proxies)
+        logger.info('Loaded %d proxies from %s.', len(proxies), self.cache_file)
 
-    @classmethod
-    def spider_closed(cls):
-        cls.hbase.close()
+    def _save_cache(self, proxies):
+        path = self.cache_file + '.tmp'
+        try:
+            with open(path, 'w') as f:
+                json.dump(proxies, f)
+            os.rename(path, self.cache_file)
+        except (IOError, OSError) as e:
+            logger.warning('Cant write proxy cache %s: %s', self.cache_file, e)
+
+    def spider_opened(self, spider):
+        self.refresh_task = task.LoopingCall(self.refresh)
+        self.refresh_task.start(self.timeout, now=True)
+
+    def spider_closed(self, spider):
+        if self.refresh_task and self.refresh_task.running:
+            self.refresh_task.stop()
+
+    def _get_proxies(self):
+        proxies = [r.row for r in self.storage.scan(columns=self.columns)]
+        if self.cache_file:
+            self._save_cache(proxies)
+        return proxies
+
+    def refresh(self):
+        if self.refreshing is not None:
+            return
+        self.refreshing = self.storage.backend.defer(self._get_proxies)
+        self.refreshing.addCallbacks(self._refreshed, self._refresh_failed, callbackArgs=(time.time(),))
+        self.refreshing.addBoth(self._refresh_done)
+
+    def _refreshed(self, proxies, started):
+        # swapped in one go from the reactor thread, requests never see a half updated pool
+        self.pool.replace(proxies)
+        self.stats.set_value('proxy/refresh_latency', time.time() - started)
+        self.stats.set_value('proxy/pool_size', len(self.pool))
+
+    def _refresh_failed(self, failure):
+        logger.warning('Keep %d proxies, refresh failed: %s', len(self.pool), failure.getErrorMessage())
+        self.stats.inc_value('proxy/refresh_failures')
+
+    def _refresh_done(self, result):
+        self.refreshing = None
+        waiting, self.waiting = self.waiting, []
+        for d in waiting:
+            d.callback(None)
+
+    def remove_proxy(self, proxy):
+        d = self.storage.backend.defer(self.storage.delete, proxy)
+        d.addErrback(lambda f: logger.warning('Removed proxy %s only locally: %s', proxy, f.getErrorMessage()))
+        if not self.pool:
+            self.crawler.engine.close_spider(self.crawler.spider, 'proxy list empty')
 
     def process_request(self, request, spider):
-        now = time.time()
-        if now - self.checked >= self.timeout:
-            self._get_proxies()
-
-        if not self.http_proxies:
+        if not self.pool and self.refreshing is not None:
+            # no cached proxies, wait for the table instead of dropping the request
+            d = defer.Deferred()
+            d.addCallback(lambda _: self._use_proxy(request, spider))
+            self.waiting.append(d)
+            return d
+        self._use_proxy(request, spider)
+
+    def _use_proxy(self, request, spider):
+        proxy = self.pool.sample()
+        if not proxy:
             raise IgnoreRequest('proxy list empty')
+        request.meta['proxy'] = proxy
+        if self.proxy_slots:
+            request.meta['download_slot'] = proxy
+            self._proxy_slot(proxy)
+        spider.log('Using proxy: %s' % proxy)
+
+    def _proxy_slot(self, proxy):
+        # created here with the proxy budget, the downloader would use the per domain one
+        slots = self.crawler.engine.downloader.slots
+        if proxy not in slots:
+            slots[proxy] = Slot(self.slot_concurrency, self.slot_delay, self.randomize_delay)
 
-        proxy = self.r.choice(self.http_proxies)
+    def process_response(self, request, response, spider):
+        proxy = request.meta.get('proxy')
         if proxy:
-            request.meta['proxy'] = proxy
-            spider.log('Using proxy: %s' % proxy)
+            if response.status < 500:
+                self.pool.success(proxy, request.meta.get('download_latency'))
+            else:
+                self.pool.failure(proxy)
+        return response
+
+    def process_exception(self, request, exception, spider):
+        proxy = request.meta.get('proxy')
+        if proxy:
+            self.pool.failure(proxy, timeout=isinstance(exception, (TimeoutError, defer.TimeoutError)))
 
 
 class CaptchaRedirectMiddleware(object):
@@ -106,6 +192,7 @@ class CaptchaRedirectMiddleware(object):
     def __init__(self, crawler):
         self.crawler = crawler
         self.captcha = crawler.settings.get('CAPTCHA_URL')
+        self.pool = ProxyPool.from_crawler(crawler)
 
     @classmethod
     def from_crawler(cls, crawler):
@@ -120,8 +207,7 @@ class CaptchaRedirectMiddleware(object):
         if self.captcha in location:
             if 'proxy' in request.meta:
                 spider.log('Request <%s> redirected to captcha using proxy: %s.' % (request.url, request.meta['proxy']))
-                if RandomHttpProxyMiddleware.remove_proxy(request.meta['proxy']):
-                    self.crawler.engine.close_spider(spider, 'proxy list empty')
+                self.pool.captcha(request.meta['proxy'])
             redirected = request.replace(url=request.url, method='GET', body='')
             redirected.headers.pop('Content-Type', None)
             redirected.headers.pop('Content-Length', None)
@@ -137,6 +223,7 @@ class ProxyTimeoutMiddleware(object):
                 or not self.proxy_max_retry_times:
             raise NotConfigured
         self.crawler = crawler
+        self.pool = ProxyPool.from_crawler(crawler)
         self.retry_proxies = {}
 
     @classmethod
@@ -152,82 +239,73 @@ class ProxyTimeoutMiddleware(object):
             count = self.retry_proxies.get(proxy, 0) + 1
             self.retry_proxies[proxy] = count
             if count >= self.proxy_max_retry_times:
-                if RandomHttpProxyMiddleware.remove_proxy(proxy):
-                    self.crawler.engine.close_spider(spider, 'proxy list empty')
-                spider.log('Remove proxy: %s.' % proxy)
+                self.pool.quarantine(proxy)
+                spider.log('Quarantine proxy: %s.' % proxy)
                 del self.retry_proxies[proxy]
 
 
 class IgnoreRequestMiddleware(object):
-    column_family = 'cf'
-    qualifier = '0'
-
-    def __init__(self, settings):
-        self.host = settings.get('HBASE_HOST')
-        self.port = settings.get('HBASE_PORT')
-        self.table = settings.get('HISTORY_TABLE')
-
-        self.hbase = HbaseWrapper(self.host, self.port, self.table)
-        column_families = (Hbase.ColumnDescriptor(name=self.column_family, maxVersions=1, timeToLive=86400),)
-        self.hbase.create_table_if_not_exists(column_families)
-
-    def _is_crawled(self, row_key):
-        columns = (self.hbase.column(self.column_family, self.qualifier),)
-        rows = self.hbase.get(row_key, columns)
-        return True if len(rows) > 0 else False
+    def __init__(self, history):
+        self.history = history
 
     @classmethod
     def from_crawler(cls, crawler):
-        s = cls(crawler.settings)
-        crawler.signals.connect(s.spider_closed, signal=signals.spider_closed)
-        return s
-
-    def spider_closed(self):
-        self.hbase.close()
+        return cls(CrawlHistory.from_crawler(crawler))
 
     def process_request(self, request, spider):
         if request.meta.get('check_crawled', False):
+            row_key = self.history.request_fingerprint(request)
+            # a bloom negative is certain, only possible hits cost a round trip
+            if not self.history.maybe_crawled(row_key):
+                return
             spider.log('Checking history for <%s>.' % request.url)
-            m = hashlib.md5(request.url)
-            if 'suffix' in request.meta:
-                m.update(request.meta['suffix'])
-            if self._is_crawled(m.hexdigest()):
-                spider.log('Request crawled: <%s>, ignore it.' % request.url)
-                raise IgnoreRequest('request crawled')
+            d = self.history.is_crawled(row_key)
+            d.addCallback(self.history.checked)
+            d.addCallback(self._ignore_crawled, request, spider)
+            return d
 
+    def _ignore_crawled(self, crawled, request, spider):
+        if crawled:
+            spider.log('Request crawled: <%s>, ignore it.' % request.url)
+            raise IgnoreRequest('request crawled')
 
-class UrlRecordMiddleware(object):
-    column_family = 'cf'
-    qualifier = '0'
 
+class UrlRecordMiddleware(object):
     @classmethod
     def from_crawler(cls, crawler):
-        s = cls(crawler.settings)
-        crawler.signals.connect(s.spider_closed, signal=signals.spider_closed)
-        return s
+        return cls(CrawlHistory.from_crawler(crawler))
 
-    def __init__(self, settings):
-        self.host = settings.get('HBASE_HOST')
-        self.port = settings.get('HBASE_PORT')
-        self.table = settings.get('HISTORY_TABLE')
-
-        self.hbase = HbaseWrapper(self.host, self.port, self.table)
-        column_families = (Hbase.ColumnDescriptor(name=self.column_family, maxVersions=1, timeToLive=86400),)
-        self.hbase.create_table_if_not_exists(column_families)
-
-    def spider_closed(self):
-        self.hbase.close()
-
-    def _record(self, row_key):
-        mutations = (self.hbase.mutation(self.column_family, self.qualifier),)
-        self.hbase.put(row_key, mutations)
+    def __init__(self, history):
+        self.history = history
 
     def process_spider_input(self, response, spider):
         if response.meta.get('check_crawled', False) and 200 <= response.status < 300:
             spider.log('Recording <%s> into request history.' % response.url)
-            m = hashlib.md5(response.url)
-            if 'suffix' in response.meta:
-                m.update(response.meta['suffix'])
-            self._record(m.hexdigest())
-            return
+            # queued only, CrawlHistory writes them in batches and on spider_closed
+            self.history.record(self.history.fingerprint(response.url, response.meta.get('suffix')))
+
 
+class AreaLeaseMiddleware(object):
+    def __init__(self, leases):
+        self.leases = leases
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.getbool('LEASE_ENABLED'):
+            raise NotConfigured
+        return cls(AreaLeases.from_crawler(crawler))
+
+    def process_spider_output(self, response, result, spider):
+        for r in result:
+            yield r
+        # the callback has scheduled every follow up page of the area by now
+        self.leases.finished(response.request)
+
+    def process_spider_exception(self, response, exception, spider):
+        self.leases.finished(response.request)
+
+    def process_exception(self, request, exception, spider):
+        # as a downloader middleware, pages failed after their retries or ignored never reach the spider.
+        # an errback may still schedule pages of the area, it finishes the request itself
+        if request.errback is None:
+            self.leases.finished(request)
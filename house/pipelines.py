@@ -6,12 +6,28 @@
 # See: http://doc.scrapy.org/en/latest/topics/item-pipeline.html
 
 import datetime
+import logging
+import os
+import socket
+import time
 
 from hbase import Hbase
-
-from house.hbase_wrapper import HbaseWrapper
+from scrapy.exceptions import DropItem, NotConfigured
+from twisted.internet import defer, task
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+from house.index import LastSeenIndex
+from house.quarantine import InvalidItemSink
+from house.spool import MutationSpool
+from house.storage import StorageUnavailable, backend_from_crawler
 from house.items import SecondhandHouseItem, NewHouseItem, SoldHouseItem
 
+logger = logging.getLogger(__name__)
 
 # reload(sys)
 # sys.setdefaultencoding("utf-8")
@@ -19,143 +35,304 @@ from house.items import SecondhandHouseItem, NewHouseItem, SoldHouseItem
 
 class HousePipeline(object):
     cf_basic = 'basic'
+    table_setting = None
 
-    def __init__(self, stats, host, port, table):
-        self.host = host
-        self.port = port
+    def __init__(self, stats, backend, table, batch_size=1, batch_timeout=0, spool=None, invalid_items=None):
         self.table = table
         self.created_at = datetime.datetime.now().strftime('%y%m%d')
         self.reversed_day = 991231 - int(self.created_at)
-        self.hbase = HbaseWrapper(self.host, self.port, self.table)
-        self.ctime = self.hbase.mutation(self.cf_basic, 'ctime', self.created_at)
+        self.backend = backend
+        self.storage = backend.table(self.table)
+        self.ctime = self.storage.mutation(self.cf_basic, 'ctime', self.created_at)
         self.stats = stats
-        self.invalid_items = []
+        self.invalid_items = invalid_items
+        self.batch_size = batch_size
+        self.batch_timeout = batch_timeout
+        self.batch = []
+        self.batched_at = time.time()
+        self.flush_task = None
+        self.spool = spool
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(
+            stats=crawler.stats,
+            backend=backend_from_crawler(crawler),
+            table=crawler.settings.get(cls.table_setting),
+            batch_size=crawler.settings.getint('HBASE_BATCH_SIZE', 1),
+            batch_timeout=crawler.settings.getfloat('HBASE_BATCH_TIMEOUT', 0),
+            spool=MutationSpool.from_crawler(crawler) if crawler.settings.getbool('SPOOL_ENABLED') else None,
+            invalid_items=InvalidItemSink.from_crawler(crawler)
+        )
 
     def open_spider(self, spider):
         column_families = (Hbase.ColumnDescriptor(name=self.cf_basic, maxVersions=1),)
-        self.hbase.create_table_if_not_exists(column_families)
+        return self._bootstrap(column_families)
+
+    def _bootstrap(self, column_families):
+        d = self.backend.defer(self.storage.create_table_if_not_exists, column_families)
+        d.addCallback(lambda _: self._start_flush_task())
+        return d
+
+    def _start_flush_task(self):
+        if self.batch_size > 1 and self.batch_timeout > 0:
+            self.flush_task = task.LoopingCall(self._flush_expired)
+            self.flush_task.start(self.batch_timeout, now=False)
+
+    def _flush_expired(self):
+        if time.time() - self.batched_at >= self.batch_timeout:
+            return self.flush()
+
+    def write(self, item, batch_mutations):
+        if self.batch_size <= 1:
+            d = self.backend.defer(self.storage.put_rows, batch_mutations)
+            d.addErrback(self._put_failed, batch_mutations)
+        else:
+            self.batch.extend(batch_mutations)
+            if len(self.batch) >= self.batch_size:
+                d = self.flush()
+            elif self.batch_timeout > 0 and time.time() - self.batched_at >= self.batch_timeout:
+                d = self.flush()
+            else:
+                return item
+        d.addCallback(lambda _: item)
+        return d
+
+    def flush(self):
+        self.batched_at = time.time()
+        if not self.batch:
+            return defer.succeed(None)
+        batch, self.batch = self.batch, []
+        d = self.backend.defer(self.storage.put_rows, batch)
+        d.addCallbacks(self._flushed, self._put_failed, callbackArgs=(batch,), errbackArgs=(batch,))
+        return d
+
+    def _flushed(self, result, batch):
+        self.stats.inc_value('storage/%s/flush_count' % self.table)
+        self.stats.inc_value('storage/%s/batched_rows' % self.table, len(batch))
+        self.stats.max_value('storage/%s/max_batch_size' % self.table, len(batch))
+
+    def _put_failed(self, failure, batch_mutations):
+        if self.spool and failure.check(StorageUnavailable):
+            logger.warning('Spool %d rows of table %s: %s', len(batch_mutations), self.table, failure.getErrorMessage())
+            self.spool.write_batch(self.table, batch_mutations)
+            return
+        logger.error('Lost %d rows of table %s: %s', len(batch_mutations), self.table, failure.getErrorMessage())
+        self.stats.inc_value('storage/%s/lost_rows' % self.table, len(batch_mutations))
+
+    def invalid(self, item, missing=None):
+        if missing is None:
+            missing = [f for f in sorted(item.fields) if not item.get(f)]
+        if self.invalid_items:
+            self.invalid_items.add(item, missing)
+        return item
 
     def close_spider(self, spider):
-        self.hbase.close()
-        # if self.transport.isOpen():
-        #     # self.transport.flush()
-        #     self.transport.close()
+        if self.flush_task and self.flush_task.running:
+            self.flush_task.stop()
+        return self.flush()
 
 
 class SecondhandHousePipeline(HousePipeline):
     cf_price = 'price'
+    table_setting = 'SECONDHAND_HOUSE_TABLE'
 
-    def __init__(self, stats, host, port, table):
-        super(SecondhandHousePipeline, self).__init__(stats, host, port, table)
-        self.ctime = self.hbase.mutation(self.cf_price, 'ctime', self.created_at)
+    def __init__(self, *args, **kwargs):
+        self.index = kwargs.pop('index', None)
+        super(SecondhandHousePipeline, self).__init__(*args, **kwargs)
+        self.ctime = self.storage.mutation(self.cf_price, 'ctime', self.created_at)
 
     @classmethod
     def from_crawler(cls, crawler):
-        return cls(
-            stats=crawler.stats,
-            host=crawler.settings.get('HBASE_HOST', 'localhost'),
-            port=crawler.settings.get('HBASE_PORT', 9090),
-            table=crawler.settings.get('SECONDHAND_HOUSE_TABLE')
-        )
+        pipeline = super(SecondhandHousePipeline, cls).from_crawler(crawler)
+        if crawler.settings.getbool('SECONDHAND_CHANGE_ONLY'):
+            pipeline.index = LastSeenIndex.from_crawler(crawler)
+        return pipeline
 
     def open_spider(self, spider):
         column_families = (Hbase.ColumnDescriptor(name=self.cf_basic, maxVersions=1),
                            Hbase.ColumnDescriptor(name=self.cf_price, maxVersions=1, timeToLive=365 * 24 * 60 * 60))
-        self.hbase.create_table_if_not_exists(column_families)
+        d = self._bootstrap(column_families)
+        if self.index:
+            d.addCallback(lambda _: self.backend.defer(self.index.load))
+        return d
 
     def process_item(self, item, spider):
         if not isinstance(item, SecondhandHouseItem):
             return item
-        if not item['id']:
-            self.invalid_items.append(item)
-            self.stats.set_value('invalid_items', self.invalid_items)
-            return item
-
+        if not item.get('id'):
+            return self.invalid(item)
+
+        basic_changed = price_changed = True
+        if self.index:
+            if not self.index.first_seen(item['id']):
+                self.stats.inc_value('secondhand/duplicate_items')
+                raise DropItem('Duplicate house %s' % item['id'])
+            basic_changed, price_changed = self.index.update(
+                item['id'], item.get('total'), item.get('unit'),
+                [item.get(q) for q in self.index.basic_qualifiers])
+            if not basic_changed and not price_changed:
+                self.stats.inc_value('secondhand/unchanged_items')
+                return item
+
+        batch_mutations = []
         mutations = []
         row_key = item['id']
-        for qualifier in ('city', 'title', 'room',
-                          'comm', 'id', 'main',
-                          'sub', 'space', 'tags', 'b_year'):
-            value = item.get(qualifier)
-            if qualifier:
-                m = self.hbase.mutation(self.cf_basic, qualifier, value)
-                mutations.append(m)
-        for qualifier in ('total', 'unit'):
-            value = item.get(qualifier)
-            if qualifier:
-                m = self.hbase.mutation(self.cf_price, qualifier, value)
-                mutations.append(m)
-
-        self.hbase.put(row_key, mutations)
-
-        mutations = [self.ctime]
-        row_key = '%s-%d' % (item['id'], self.reversed_day)
-        for qualifier in ('total', 'unit'):
-            value = item.get(qualifier)
-            if qualifier:
-                m = self.hbase.mutation(self.cf_price, qualifier, value)
-                mutations.append(m)
-        self.hbase.put(row_key, mutations)
-        return item
+        if basic_changed:
+            for qualifier in LastSeenIndex.basic_qualifiers:
+                value = item.get(qualifier)
+                if qualifier:
+                    m = self.storage.mutation(self.cf_basic, qualifier, value)
+                    mutations.append(m)
+        if price_changed:
+            for qualifier in LastSeenIndex.price_qualifiers:
+                value = item.get(qualifier)
+                if qualifier:
+                    m = self.storage.mutation(self.cf_price, qualifier, value)
+                    mutations.append(m)
+        batch_mutations.append(self.storage.batch_mutation(row_key, mutations))
+
+        if price_changed:
+            self.stats.inc_value('secondhand/price_changes')
+            mutations = [self.ctime]
+            row_key = '%s-%d' % (item['id'], self.reversed_day)
+            for qualifier in LastSeenIndex.price_qualifiers:
+                value = item.get(qualifier)
+                if qualifier:
+                    m = self.storage.mutation(self.cf_price, qualifier, value)
+                    mutations.append(m)
+            batch_mutations.append(self.storage.batch_mutation(row_key, mutations))
+        return self.write(item, batch_mutations)
 
 
 class SoldHousePipeline(HousePipeline):
-    def __init__(self, stats, host, port, table):
-        super(SoldHousePipeline, self).__init__(stats, host, port, table)
-
-    @classmethod
-    def from_crawler(cls, crawler):
-        return cls(
-            stats=crawler.stats,
-            host=crawler.settings.get('HBASE_HOST', 'localhost'),
-            port=crawler.settings.get('HBASE_PORT', 9090),
-            table=crawler.settings.get('SOLD_HOUSE_TABLE')
-        )
+    table_setting = 'SOLD_HOUSE_TABLE'
 
     def process_item(self, item, spider):
         if not isinstance(item, SoldHouseItem):
             return item
-        if not item['id']:
-            self.invalid_items.append(item)
-            self.stats.set_value('invalid_items', self.invalid_items)
-            return item
+        # both make up the row key
+        if not item.get('id') or not item.get('deal'):
+            return self.invalid(item)
 
         mutations = []
         row_key = '%s-%s' % (item['id'], item['deal'])
         for qualifier in item:
-            m = self.hbase.mutation(self.cf_basic, qualifier, item[qualifier])
+            m = self.storage.mutation(self.cf_basic, qualifier, item[qualifier])
             mutations.append(m)
-        self.hbase.put(row_key, mutations)
-
-        return item
+        return self.write(item, [self.storage.batch_mutation(row_key, mutations)])
 
 
 class NewHousePipeline(HousePipeline):
-    def __init__(self, stats, host, port, table):
-        super(NewHousePipeline, self).__init__(stats, host, port, table)
-
-    @classmethod
-    def from_crawler(cls, crawler):
-        return cls(
-            stats=crawler.stats,
-            host=crawler.settings.get('HBASE_HOST', 'localhost'),
-            port=crawler.settings.get('HBASE_PORT', 9090),
-            table=crawler.settings.get('NEW_HOUSE_TABLE')
-        )
+    table_setting = 'NEW_HOUSE_TABLE'
 
     def process_item(self, item, spider):
         if not isinstance(item, NewHouseItem):
             return item
         if None in item.values():
-            self.invalid_items.append(item)
-            self.stats.set_value('invalid_items', self.invalid_items)
-            return item
+            return self.invalid(item, [k for k, v in item.items() if v is None])
 
         mutations = []
         row_key = '%s-%d' % (item['id'], self.reversed_day)
         for qualifier in item:
-            m = self.hbase.mutation(self.column_family, qualifier, item[qualifier])
+            m = self.storage.mutation(self.cf_basic, qualifier, item[qualifier])
             mutations.append(m)
-        self.hbase.put(row_key, mutations)
+        return self.write(item, [self.storage.batch_mutation(row_key, mutations)])
+
+
+class SnapshotExportPipeline(object):
+    names = {SecondhandHouseItem: 'secondhand', SoldHouseItem: 'sold', NewHouseItem: 'new'}
+    # columns not listed here are dictionary encoded strings
+    numeric_fields = {
+        SecondhandHouseItem: {'total': 'float64', 'unit': 'int64', 'space': 'float64', 'b_year': 'int32'},
+        SoldHouseItem: {'total': 'float64', 'unit': 'int64', 'space': 'float64', 'b_year': 'int32',
+                        'hang': 'float64', 'period': 'int32'},
+        NewHouseItem: {'price': 'int64', 'f_space': 'float64', 'b_space': 'float64', 'p_year': 'int32'},
+    }
+    converters = {'float64': float, 'int64': int, 'int32': int}
+
+    def __init__(self, stats, directory, batch_size=10000):
+        self.stats = stats
+        self.directory = directory
+        self.batch_size = batch_size
+        self.day = datetime.datetime.now().strftime('%Y%m%d')
+        self.schemas = {}
+        for item_class, numeric in self.numeric_fields.items():
+            self.schemas[item_class] = pyarrow.schema([
+                pyarrow.field(f, getattr(pyarrow, numeric[f])()) if f in numeric
+                else pyarrow.field(f, pyarrow.dictionary(pyarrow.int32(), pyarrow.string()))
+                for f in sorted(item_class.fields)])
+        self.columns = {}
+        self.writers = {}
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.getbool('SNAPSHOT_EXPORT_ENABLED'):
+            raise NotConfigured
+        if pyarrow is None:
+            raise NotConfigured('pyarrow is required to export snapshots')
+        return cls(
+            stats=crawler.stats,
+            directory=crawler.settings.get('SNAPSHOT_EXPORT_DIR', 'snapshots'),
+            batch_size=crawler.settings.getint('SNAPSHOT_EXPORT_BATCH_SIZE', 10000)
+        )
+
+    def _convert(self, kind, value):
+        if value is None or value == '':
+            return None
+        if kind is None:
+            return value.decode('utf-8') if isinstance(value, str) else value
+        try:
+            return self.converters[kind](value)
+        except ValueError:
+            return None
 
+    def process_item(self, item, spider):
+        item_class = type(item)
+        if item_class not in self.schemas:
+            return item
+
+        key = (item_class, item.get('city'))
+        columns = self.columns.get(key)
+        if columns is None:
+            columns = self.columns[key] = dict((f, []) for f in self.schemas[item_class].names)
+        numeric = self.numeric_fields[item_class]
+        for field, values in columns.items():
+            values.append(self._convert(numeric.get(field), item.get(field)))
+        if len(columns['id']) >= self.batch_size:
+            self._flush(key)
         return item
+
+    def _writer(self, key):
+        writer = self.writers.get(key)
+        if writer is None:
+            item_class, city = key
+            directory = os.path.join(self.directory, self.names[item_class],
+                                     'city=%s' % (city or 'unknown'), 'day=%s' % self.day)
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            path = os.path.join(directory, 'part-%s-%d-%d.parquet' % (socket.gethostname(), os.getpid(), time.time()))
+            writer = self.writers[key] = pyarrow.parquet.ParquetWriter(path, self.schemas[item_class])
+        return writer
+
+    def _flush(self, key):
+        columns = self.columns.pop(key, None)
+        if not columns or not columns['id']:
+            return
+        item_class = key[0]
+        schema = self.schemas[item_class]
+        numeric = self.numeric_fields[item_class]
+        arrays = [pyarrow.array(columns[name], type=schema.field(name).type) if name in numeric
+                  else pyarrow.array(columns[name], type=pyarrow.string()).dictionary_encode()
+                  for name in schema.names]
+        batch = pyarrow.RecordBatch.from_arrays(arrays, schema.names)
+        self._writer(key).write_table(pyarrow.Table.from_batches([batch]))
+        self.stats.inc_value('snapshot/%s/rows' % self.names[item_class], batch.num_rows)
+        self.stats.inc_value('snapshot/%s/batches' % self.names[item_class])
+
+    def close_spider(self, spider):
+        for key in list(self.columns):
+            self._flush(key)
+        for writer in self.writers.values():
+            writer.close()
+        self.writers = {}
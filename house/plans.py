@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+import json
+import logging
+import os
+import time
+
+from scrapy import signals
+
+logger = logging.getLogger(__name__)
+
+
+class CrawlPlan(object):
+    # the navigation a run discovered before its first listing page, per city the nav urls, the main areas
+    # of every kind and their page counts, kept in a local file. the next run requests the areas straight
+    # from it and only walks the sitemap again once the city is older than ttl
+    def __init__(self, path, ttl=86400):
+        self.path = path
+        self.ttl = ttl
+        self.cities = {}
+        self.changed = False
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        plan = getattr(crawler, 'crawl_plan', None)
+        if plan is None:
+            plan = cls(crawler.settings.get('PLAN_FILE', 'plan.json'), crawler.settings.getint('PLAN_TTL', 86400))
+            plan.load()
+            crawler.crawl_plan = plan
+            crawler.signals.connect(plan.spider_closed, signal=signals.spider_closed)
+        return plan
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path) as f:
+                self.cities = json.load(f)
+        except (IOError, ValueError) as e:
+            logger.warning('Cant read crawl plan %s: %s', self.path, e)
+            return
+        logger.info('Loaded crawl plan of %d cities from %s.', len(self.cities), self.path)
+
+    def save(self):
+        path = self.path + '.tmp'
+        try:
+            with open(path, 'w') as f:
+                json.dump(self.cities, f)
+            os.rename(path, self.path)
+        except (IOError, OSError) as e:
+            logger.warning('Cant write crawl plan %s: %s', self.path, e)
+
+    def get(self, city):
+        return self.cities.get(city)
+
+    def fresh(self, city):
+        plan = self.cities.get(city)
+        return plan is not None and plan.get('time', 0) + self.ttl > time.time()
+
+    def _city(self, city):
+        self.changed = True
+        return self.cities.setdefault(city, {'navs': {}, 'areas': {}, 'pages': {}})
+
+    def record_nav(self, city, kind, url):
+        self._city(city)['navs'][kind] = url
+
+    def record_areas(self, city, kind, areas):
+        # a city is as old as its area lists
+        plan = self._city(city)
+        plan['areas'][kind] = [list(a) for a in areas]
+        plan['time'] = time.time()
+
+    def record_pages(self, city, kind, area, pages):
+        plan = self.cities.get(city)
+        if plan is None or plan['pages'].get(kind, {}).get(area) == pages:
+            return
+        plan['pages'].setdefault(kind, {})[area] = pages
+        self.changed = True
+
+    def areas(self, city, kind):
+        # biggest areas first, the long ones are not left to the end of the crawl
+        plan = self.cities.get(city)
+        if plan is None:
+            return []
+        pages = plan['pages'].get(kind, {})
+        return sorted((tuple(a) for a in plan['areas'].get(kind, [])), key=lambda a: -pages.get(a[0], 0))
+
+    def spider_closed(self):
+        if self.changed:
+            self.save()
+            self.changed = False
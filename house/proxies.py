@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+import logging
+import time
+from collections import deque
+from random import Random
+
+logger = logging.getLogger(__name__)
+
+
+class ProxyHealth(object):
+    __slots__ = ('latency', 'success', 'failures', 'captchas', 'timeouts', 'strikes', 'probation')
+
+    def __init__(self, probation=0):
+        self.latency = None
+        self.success = 1.0
+        self.failures = 0
+        self.captchas = 0
+        self.timeouts = 0
+        self.strikes = 0
+        self.probation = probation
+
+
+class ProxyPool(object):
+    # active proxies live in a list with a position index, so add, remove and
+    # weighted sampling (by rejection) are all constant time.
+    # a bad proxy is quarantined for quarantine_time * 2 ** (strikes - 1) and comes back on probation,
+    # after max_strikes it is dropped for good. one fifo per strike keeps release constant time too.
+    r = Random()
+    alpha = 0.2
+    max_tries = 32
+
+    def __init__(self, latency_scale=2.0, min_weight=0.05, probation=3, probation_weight=0.2,
+                 max_failures=3, quarantine_time=60, max_strikes=5, stats=None):
+        self.latency_scale = latency_scale
+        self.min_weight = min_weight
+        self.probation = probation
+        self.probation_weight = probation_weight
+        self.max_failures = max_failures
+        self.quarantine_time = quarantine_time
+        self.max_strikes = max_strikes
+        self.stats = stats
+        self.active = []
+        self.positions = {}
+        self.health = {}
+        self.quarantined = dict((strike, deque()) for strike in range(1, max_strikes + 1))
+        # proxy -> its entry in the fifos, entries of discarded or requarantined proxies are left behind
+        self.quarantine_entries = {}
+        # called with a proxy dropped for good
+        self.on_drop = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        pool = getattr(crawler, 'proxy_pool', None)
+        if pool is None:
+            settings = crawler.settings
+            pool = cls(latency_scale=settings.getfloat('PROXY_LATENCY_SCALE', 2.0),
+                       probation=settings.getint('PROXY_PROBATION', 3),
+                       max_failures=settings.getint('PROXY_MAX_FAILURES', 3),
+                       quarantine_time=settings.getfloat('PROXY_QUARANTINE_TIME', 60),
+                       max_strikes=settings.getint('PROXY_MAX_STRIKES', 5),
+                       stats=crawler.stats)
+            crawler.proxy_pool = pool
+        return pool
+
+    def __len__(self):
+        return len(self.active) + len(self.quarantine_entries)
+
+    def __contains__(self, proxy):
+        return proxy in self.health
+
+    def _inc_stats(self, key):
+        if self.stats:
+            self.stats.inc_value('proxy/%s' % key)
+
+    def _activate(self, proxy):
+        self.positions[proxy] = len(self.active)
+        self.active.append(proxy)
+
+    def _deactivate(self, proxy):
+        i = self.positions.pop(proxy, None)
+        if i is None:
+            return
+        last = self.active.pop()
+        if last != proxy:
+            self.active[i] = last
+            self.positions[last] = i
+
+    def add(self, proxy):
+        if proxy not in self.health:
+            self.health[proxy] = ProxyHealth()
+            self._activate(proxy)
+
+    def discard(self, proxy):
+        # quarantined entries are skipped when they are released
+        if self.health.pop(proxy, None) is not None:
+            self._deactivate(proxy)
+            self.quarantine_entries.pop(proxy, None)
+
+    def replace(self, proxies):
+        proxies = set(proxies)
+        for proxy in list(self.health):
+            if proxy not in proxies:
+                self.discard(proxy)
+        for proxy in proxies:
+            self.add(proxy)
+
+    def weight(self, proxy):
+        h = self.health[proxy]
+        latency = self.latency_scale if h.latency is None else h.latency
+        weight = max(self.min_weight, h.success * self.latency_scale / (self.latency_scale + latency))
+        if h.probation > 0:
+            weight = min(weight, self.probation_weight)
+        return weight
+
+    def sample(self):
+        self._release()
+        if not self.active:
+            if not self.quarantine_entries:
+                return None
+            # better a doubtful proxy than no request at all
+            self._release(force=True)
+            if not self.active:
+                return None
+        proxy = None
+        for _ in range(self.max_tries):
+            proxy = self.active[int(self.r.random() * len(self.active))]
+            if self.r.random() < self.weight(proxy):
+                break
+        return proxy
+
+    def success(self, proxy, latency=None):
+        h = self.health.get(proxy)
+        if h is None:
+            return
+        if latency is not None:
+            h.latency = latency if h.latency is None else h.latency + self.alpha * (latency - h.latency)
+        h.success += self.alpha * (1 - h.success)
+        h.failures = 0
+        if h.probation > 0:
+            h.probation -= 1
+            if h.probation == 0:
+                h.strikes = 0
+
+    def failure(self, proxy, timeout=False):
+        h = self.health.get(proxy)
+        if h is None:
+            return
+        h.success -= self.alpha * h.success
+        h.failures += 1
+        if timeout:
+            h.timeouts += 1
+            self._inc_stats('timeouts')
+        self._inc_stats('failures')
+        if h.failures >= self.max_failures or h.probation > 0:
+            self.quarantine(proxy)
+
+    def captcha(self, proxy):
+        h = self.health.get(proxy)
+        if h is None:
+            return
+        h.captchas += 1
+        self._inc_stats('captchas')
+        self.quarantine(proxy)
+
+    def quarantine(self, proxy):
+        h = self.health.get(proxy)
+        if h is None or proxy not in self.positions:
+            return
+        self._deactivate(proxy)
+        h.strikes += 1
+        if h.strikes > self.max_strikes:
+            del self.health[proxy]
+            logger.info('Drop proxy %s after %d quarantines.', proxy, self.max_strikes)
+            self._inc_stats('dropped')
+            if self.on_drop:
+                self.on_drop(proxy)
+            return
+        entry = (time.time() + self.quarantine_time * 2 ** (h.strikes - 1), proxy)
+        self.quarantined[h.strikes].append(entry)
+        self.quarantine_entries[proxy] = entry
+        logger.debug('Quarantine proxy %s, strike %d.', proxy, h.strikes)
+        self._inc_stats('quarantined')
+
+    def _release(self, force=False):
+        now = time.time()
+        for queue in self.quarantined.values():
+            while queue and (force or queue[0][0] <= now):
+                entry = queue.popleft()
+                proxy = entry[1]
+                if self.quarantine_entries.get(proxy) is not entry:
+                    continue
+                del self.quarantine_entries[proxy]
+                h = self.health[proxy]
+                h.probation = self.probation
+                h.failures = 0
+                self._activate(proxy)
+                if force and self.active:
+                    return
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+import time
+from random import Random
+
+from scrapy import signals
+
+from house.spool import SegmentWriter
+
+
+class InvalidItemSink(object):
+    r = Random()
+
+    def __init__(self, directory, segment_size=4 * 1024 * 1024, sample_size=10, stats=None):
+        self.writer = SegmentWriter(directory, 'invalid', segment_size, sync=False)
+        self.sample_size = sample_size
+        self.sample = []
+        self.count = 0
+        self.stats = stats
+        if self.stats:
+            self.stats.set_value('invalid_items/sample', self.sample)
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        sink = getattr(crawler, 'invalid_item_sink', None)
+        if sink is None:
+            sink = cls(crawler.settings.get('INVALID_ITEMS_DIR', 'invalid'),
+                       crawler.settings.getint('INVALID_ITEMS_SEGMENT_SIZE', 4 * 1024 * 1024),
+                       crawler.settings.getint('INVALID_ITEMS_SAMPLE_SIZE', 10),
+                       crawler.stats)
+            crawler.invalid_item_sink = sink
+            crawler.signals.connect(sink.close, signal=signals.engine_stopped)
+        return sink
+
+    def add(self, item, missing):
+        name = type(item).__name__
+        record = {'type': name, 'missing': missing, 'item': dict(item), 'time': int(time.time())}
+        self.writer.write(record)
+
+        if self.stats:
+            self.stats.inc_value('invalid_items/%s' % name)
+            for field in missing:
+                self.stats.inc_value('invalid_items/%s/%s' % (name, field))
+
+        # reservoir sampling keeps every invalid item equally likely to be shown
+        self.count += 1
+        if len(self.sample) < self.sample_size:
+            self.sample.append(record)
+        else:
+            i = self.r.randint(0, self.count - 1)
+            if i < self.sample_size:
+                self.sample[i] = record
+
+    def close(self):
+        self.writer.close()
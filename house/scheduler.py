@@ -0,0 +1,304 @@
+# -*- coding: utf-8 -*-
+import cPickle as pickle
+import datetime
+import itertools
+import logging
+import os
+import random
+import socket
+import time
+from collections import deque
+
+from hbase import Hbase
+from scrapy import signals
+from scrapy.exceptions import DontCloseSpider
+from scrapy.utils.reqser import request_from_dict, request_to_dict
+from scrapy.utils.request import request_fingerprint
+
+from house.storage import StorageUnavailable, backend_from_crawler
+
+logger = logging.getLogger(__name__)
+
+
+class SharedScheduler(object):
+    # queued requests are rows q<priority>-<fingerprint>, fingerprints seen today are rows s<day>-<fingerprint>.
+    # a node enqueues a request only if it wins the seen row and fetches it only if it wins the claim
+    # on the queue row, both with check_and_put. a claim expires after claim_ttl and the row is deleted
+    # once its request was fetched, so the requests of a crashed node are taken over by the others
+    column_family = 'cf'
+    ttl = 2 * 86400
+
+    def __init__(self, crawler, storage, node_id, prefetch=20, push_batch_size=100,
+                 poll_interval=1, idle_timeout=60, claim_ttl=300, max_claims=3):
+        self.crawler = crawler
+        self.stats = crawler.stats
+        self.storage = storage
+        self.node_id = node_id
+        self.prefetch = prefetch
+        self.push_batch_size = push_batch_size
+        self.poll_interval = poll_interval
+        self.idle_timeout = idle_timeout
+        self.claim_ttl = claim_ttl
+        self.max_claims = max_claims
+        self.day = datetime.datetime.now().strftime('%y%m%d')
+        self.tokens = itertools.count()
+        self.claim_column = storage.column(self.column_family, 'claim')
+        self.request_column = storage.column(self.column_family, 'req')
+        self.spider = None
+        # requests claimed by this node and waiting for the engine
+        self.inbox = deque()
+        # requests waiting to be pushed to the frontier
+        self.outbox = []
+        # queue rows of fetched requests, deleted with the next pop
+        self.fetched = []
+        self.pushing = 0
+        self.popping = None
+        self.polled_at = 0
+        self.active_at = time.time()
+        self.frontier_empty = False
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        settings = crawler.settings
+        table = settings.get('FRONTIER_TABLE', 'frontier')
+        node_id = settings.get('FRONTIER_NODE_ID') or '%s-%d' % (socket.gethostname(), os.getpid())
+        scheduler = cls(crawler, backend_from_crawler(crawler).table(table), node_id,
+                        prefetch=settings.getint('FRONTIER_PREFETCH', 20),
+                        push_batch_size=settings.getint('FRONTIER_PUSH_BATCH_SIZE', 100),
+                        poll_interval=settings.getfloat('FRONTIER_POLL_INTERVAL', 1),
+                        idle_timeout=settings.getfloat('FRONTIER_IDLE_TIMEOUT', 60),
+                        claim_ttl=settings.getint('FRONTIER_CLAIM_TTL', 300),
+                        max_claims=settings.getint('FRONTIER_MAX_CLAIMS', 3))
+        crawler.signals.connect(scheduler.spider_idle, signal=signals.spider_idle)
+        crawler.signals.connect(scheduler.response_received, signal=signals.response_received)
+        return scheduler
+
+    def open(self, spider):
+        self.spider = spider
+        column_families = (Hbase.ColumnDescriptor(name=self.column_family, maxVersions=1, timeToLive=self.ttl),)
+        return self.storage.backend.defer(self.storage.create_table_if_not_exists, column_families)
+
+    def close(self, reason):
+        # requests claimed but never fetched go back to the frontier for the other nodes
+        claimed = [r.meta['frontier_row'] for r in self.inbox if 'frontier_row' in r.meta]
+        rows = [self._queue_row(r) for r in self.inbox if 'frontier_row' not in r.meta]
+        self.inbox.clear()
+        outbox, self.outbox = self.outbox, []
+        fetched, self.fetched = self.fetched, []
+        d = self.storage.backend.defer(self._close, claimed, rows, outbox, fetched)
+        d.addErrback(self._failed, 'close frontier')
+        return d
+
+    def _close(self, claimed, rows, outbox, fetched):
+        self._push(outbox)
+        self._delete(fetched)
+        if claimed:
+            delete = [Hbase.Mutation(column=self.claim_column, isDelete=True)]
+            self.storage.put_rows([self.storage.batch_mutation(row_key, delete) for row_key in claimed])
+        if rows:
+            self.storage.put_rows(rows)
+        if claimed or rows:
+            logger.info('Returned %d claimed requests to the frontier.', len(claimed) + len(rows))
+
+    def __len__(self):
+        return len(self.inbox) + len(self.outbox)
+
+    def has_pending_requests(self):
+        return bool(self.inbox or self.outbox or self.pushing or self.popping or not self.frontier_empty)
+
+    def spider_idle(self, spider):
+        # other nodes may still be filling the frontier
+        if time.time() - self.active_at < self.idle_timeout:
+            self.frontier_empty = False
+            raise DontCloseSpider
+
+    def fingerprint(self, request):
+        fp = request_fingerprint(request)
+        if request.dont_filter:
+            # every node yields the same start requests, only retries are new
+            fp = '%s%d' % (fp, request.meta.get('retry_times', 0))
+        return fp
+
+    def _token(self):
+        return '%s:%d' % (self.node_id, next(self.tokens))
+
+    def _claim(self, attempts):
+        return '%s|%d|%d' % (self._token(), time.time() + self.claim_ttl, attempts)
+
+    def _parse_claim(self, claim):
+        # claims are token|expires|attempts
+        if claim is None:
+            return 0, 0
+        _, expires, attempts = claim.rsplit('|', 2)
+        return int(expires), int(attempts)
+
+    def _acquire(self, row_key, current=None, token=None):
+        token = token or self._token()
+        mutation = self.storage.mutation(self.column_family, 'claim', token)
+        if self.storage.check_and_put(row_key, self.claim_column, current, mutation):
+            return True
+        # a retried call may have won the first time
+        rows = self.storage.get(row_key, [self.claim_column])
+        cell = rows[0].columns.get(self.claim_column) if rows else None
+        return cell is not None and cell.value == token
+
+    def _queue_row(self, request, fp=None):
+        row_key = 'q%08x-%s' % (0x7fffffff - request.priority, fp or self.fingerprint(request))
+        value = pickle.dumps(request_to_dict(request, self.spider), protocol=2)
+        return self.storage.batch_mutation(row_key, [self.storage.mutation(self.column_family, 'req', value)])
+
+    def response_received(self, response, request, spider):
+        self._done(request)
+
+    def _done(self, request):
+        row_key = request.meta.pop('frontier_row', None)
+        if row_key is not None:
+            self.fetched.append(row_key)
+
+    def enqueue_request(self, request):
+        # a retry or redirect of a claimed request replaces it in the frontier
+        self._done(request)
+        self.outbox.append(request)
+        self.stats.inc_value('scheduler/enqueued/shared', spider=self.spider)
+        if len(self.outbox) >= self.push_batch_size:
+            self._flush_outbox()
+        return True
+
+    def _flush_outbox(self):
+        if not self.outbox:
+            return
+        outbox, self.outbox = self.outbox, []
+        self.pushing += 1
+        d = self.storage.backend.defer(self._push, outbox)
+        d.addCallbacks(self._pushed, self._push_failed, errbackArgs=(outbox,))
+        d.addBoth(self._push_done)
+
+    def _push(self, requests):
+        rows = []
+        duplicates = 0
+        for request in requests:
+            fp = self.fingerprint(request)
+            if not self._acquire('s%s-%s' % (self.day, fp)):
+                duplicates += 1
+                continue
+            rows.append(self._queue_row(request, fp))
+        if rows:
+            self.storage.put_rows(rows)
+        return len(rows), duplicates
+
+    def _pushed(self, result):
+        pushed, duplicates = result
+        self.stats.inc_value('frontier/pushed', pushed, spider=self.spider)
+        self.stats.inc_value('frontier/duplicates', duplicates, spider=self.spider)
+        if pushed:
+            self.frontier_empty = False
+
+    def _push_failed(self, failure, requests):
+        # nobody else can have queued them, so this node fetches them itself
+        self._failed(failure, 'push %d requests' % len(requests))
+        self.inbox.extend(requests)
+
+    def _push_done(self, result):
+        self.pushing -= 1
+        self._wake()
+
+    def next_request(self):
+        self._flush_outbox()
+        if not self.inbox:
+            self._poll()
+            return None
+        self.stats.inc_value('scheduler/dequeued/shared', spider=self.spider)
+        return self.inbox.popleft()
+
+    def _poll(self):
+        now = time.time()
+        if self.popping or (self.frontier_empty and now - self.polled_at < self.poll_interval):
+            return
+        self.polled_at = now
+        fetched, self.fetched = self.fetched, []
+        self.popping = self.storage.backend.defer(self._pop, self.prefetch, fetched)
+        self.popping.addCallbacks(self._popped, self._failed, errbackArgs=('pop requests',))
+        self.popping.addBoth(self._pop_done)
+
+    def _delete(self, row_keys):
+        if row_keys:
+            deletes = [Hbase.Mutation(column=c, isDelete=True) for c in (self.request_column, self.claim_column)]
+            self.storage.put_rows([self.storage.batch_mutation(row_key, deletes) for row_key in row_keys])
+
+    def _pop(self, n, fetched):
+        try:
+            self._delete(fetched)
+        except StorageUnavailable as e:
+            # their claims expire and other nodes fetch them again
+            logger.warning('Cant delete %d fetched requests: %s', len(fetched), e)
+        # claim from a shuffled window so nodes dont all race for the same head rows
+        scanner = self.storage.scan(prefix='q', columns=[self.request_column, self.claim_column])
+        window = []
+        now = time.time()
+        try:
+            for r in scanner:
+                cell = r.columns.get(self.claim_column)
+                claim = cell.value if cell is not None else None
+                if claim is None or self._parse_claim(claim)[0] < now:
+                    window.append((r.row, claim))
+                    if len(window) >= n * 4:
+                        break
+        finally:
+            scanner.close()
+        random.shuffle(window)
+        claimed, abandoned, conflicts, expired = [], [], 0, 0
+        for row_key, claim in window:
+            if len(claimed) >= n:
+                break
+            attempts = self._parse_claim(claim)[1]
+            if attempts >= self.max_claims:
+                # claimed max_claims times and never fetched, the page fails on every node
+                abandoned.append(row_key)
+                continue
+            if self._acquire(row_key, claim, self._claim(attempts + 1)):
+                claimed.append(row_key)
+                expired += claim is not None
+            else:
+                conflicts += 1
+        # a claim also succeeds on a row another node has just fetched and deleted,
+        # only rows still holding their request are ours
+        values = []
+        if claimed:
+            rows = self.storage.get_rows(claimed, [self.request_column])
+            values = [(r.row, r.columns[self.request_column].value) for r in rows if self.request_column in r.columns]
+            conflicts += len(claimed) - len(values)
+            abandoned.extend(set(claimed) - set(row_key for row_key, _ in values))
+        try:
+            self._delete(abandoned)
+        except StorageUnavailable as e:
+            logger.warning('Cant delete %d abandoned requests: %s', len(abandoned), e)
+        return values, conflicts, expired, len(abandoned)
+
+    def _popped(self, result):
+        values, conflicts, expired, abandoned = result
+        self.stats.inc_value('frontier/claimed', len(values), spider=self.spider)
+        self.stats.inc_value('frontier/claim_conflicts', conflicts, spider=self.spider)
+        self.stats.inc_value('frontier/expired_claims', expired, spider=self.spider)
+        self.stats.inc_value('frontier/abandoned', abandoned, spider=self.spider)
+        self.frontier_empty = not values and not conflicts
+        if values:
+            self.active_at = time.time()
+        for row_key, value in values:
+            request = request_from_dict(pickle.loads(value), self.spider)
+            request.meta['frontier_row'] = row_key
+            self.inbox.append(request)
+
+    def _pop_done(self, result):
+        self.popping = None
+        self._wake()
+
+    def _wake(self):
+        slot = getattr(self.crawler.engine, 'slot', None)
+        if slot is not None:
+            slot.nextcall.schedule()
+
+    def _failed(self, failure, action):
+        if failure.check(StorageUnavailable):
+            logger.warning('Cant %s: %s', action, failure.getErrorMessage())
+        else:
+            logger.error('Cant %s: %s', action, failure.getErrorMessage())
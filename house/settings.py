@@ -42,7 +42,8 @@ USER_AGENTS = (
 ROBOTSTXT_OBEY = False
 
 # Configure maximum concurrent requests performed by Scrapy (default: 16)
-# CONCURRENT_REQUESTS = 32
+# the global cap over all proxy slots, see PROXY_SLOTS_ENABLED
+CONCURRENT_REQUESTS = 64
 
 # Configure a delay for requests for the same website (default: 0)
 # See http://scrapy.readthedocs.org/en/latest/topics/settings.html#download-delay
@@ -69,6 +70,7 @@ TELNETCONSOLE_ENABLED = False
 # See http://scrapy.readthedocs.org/en/latest/topics/spider-middleware.html
 SPIDER_MIDDLEWARES = {
     'house.middlewares.UrlRecordMiddleware': 543,
+    'house.middlewares.AreaLeaseMiddleware': 544,
 }
 
 # Enable or disable downloader middlewares
@@ -82,6 +84,7 @@ DOWNLOADER_MIDDLEWARES = {
     'house.middlewares.IgnoreRequestMiddleware': 50,
     'house.middlewares.ProxyTimeoutMiddleware': 45,
     'house.middlewares.CaptchaRedirectMiddleware': 601,
+    'house.middlewares.AreaLeaseMiddleware': 40,
 }
 
 # Enable or disable extensions
@@ -97,6 +100,7 @@ ITEM_PIPELINES = {
     'house.pipelines.SecondhandHousePipeline': 300,
     'house.pipelines.SoldHousePipeline': 310,
     'house.pipelines.NewHousePipeline': 320,
+    'house.pipelines.SnapshotExportPipeline': 330,
 }
 
 # Enable and configure the AutoThrottle extension (disabled by default)
@@ -126,21 +130,149 @@ REDIRECT_MAX_TIMES = 10
 RETRY_TIMES = 10
 #LOG_FILE = 'house.log'
 
+# house.storage, where pipelines and middlewares keep their tables:
+# house.hbase_wrapper.HbasePool or house.sqlite_wrapper.SqliteBackend
+STORAGE_BACKEND = 'house.hbase_wrapper.HbasePool'
+# calls queued beyond this wait in the reactor and hold back the engine
+STORAGE_MAX_INFLIGHT = 100
+# rows fetched per round trip when scanning a table
+STORAGE_SCAN_BATCH_SIZE = 1000
+# prefix row keys of these tables with one of N hash buckets to spread writes over regions,
+# e.g. {'secondhand': 16, 'sold': 16}. Changing it needs the existing rows rewritten.
+STORAGE_SALT_BUCKETS = {}
+SQLITE_PATH = 'house.db'
+SQLITE_POOL_SIZE = 4
+
 # hbase config
 HBASE_HOST = '127.0.0.1'
 HBASE_PORT = 9090
+# house.hbase_wrapper.HbasePool, one pool of thrift connections per crawler
+HBASE_POOL_SIZE = 10
+HBASE_TIMEOUT = 10
+HBASE_RETRY_TIMES = 5
+HBASE_RETRY_DELAY = 0.5
+HBASE_MAX_RETRY_DELAY = 10
+HBASE_BREAKER_THRESHOLD = 5
+HBASE_BREAKER_TIMEOUT = 30
+# house.pipelines.HousePipeline, buffer mutations and flush them with mutateRows
+HBASE_BATCH_SIZE = 200
+HBASE_BATCH_TIMEOUT = 10
+
+# house.spool.MutationSpool, keep rows locally while hbase is unavailable
+# replay them with: scrapy replay
+SPOOL_ENABLED = True
+SPOOL_DIR = 'spool'
+SPOOL_SEGMENT_SIZE = 16 * 1024 * 1024
+
+# house.pipelines.SecondhandHousePipeline, drop repeated houses and only write changed columns,
+# a price history row is added only when the price moved since the last crawl
+SECONDHAND_CHANGE_ONLY = False
+
+# house.quarantine.InvalidItemSink, rejected items go to rotating files,
+# stats only keep counters and a small sample
+INVALID_ITEMS_DIR = 'invalid'
+INVALID_ITEMS_SEGMENT_SIZE = 4 * 1024 * 1024
+INVALID_ITEMS_SAMPLE_SIZE = 10
+
+# house.pipelines.SnapshotExportPipeline, daily parquet files partitioned by city and day, needs pyarrow
+SNAPSHOT_EXPORT_ENABLED = False
+SNAPSHOT_EXPORT_DIR = 'snapshots'
+SNAPSHOT_EXPORT_BATCH_SIZE = 10000
 
 NEW_HOUSE_TABLE = 'new'
 SECONDHAND_HOUSE_TABLE = 'secondhand'
 SOLD_HOUSE_TABLE = 'sold'
 HISTORY_TABLE = 'history'
 PROXY_TABLE = 'proxy'
+FRONTIER_TABLE = 'frontier'
+LEASE_TABLE = 'lease'
+PAGE_DIGEST_TABLE = 'digest'
+WATERMARK_TABLE = 'watermark'
+
+# house.scheduler.SharedScheduler, every node pops requests from one frontier table
+# and a request is queued once a day across all nodes, enable on every node with:
+# SCHEDULER = 'house.scheduler.SharedScheduler'
+# defaults to host-pid
+FRONTIER_NODE_ID = None
+# requests claimed per round trip, unfetched ones are returned on close
+FRONTIER_PREFETCH = 20
+FRONTIER_PUSH_BATCH_SIZE = 100
+FRONTIER_POLL_INTERVAL = 1
+# keep an idle node open this long after it last claimed a request
+FRONTIER_IDLE_TIMEOUT = 60
+# a claimed request not fetched within FRONTIER_CLAIM_TTL seconds is taken by another node,
+# after FRONTIER_MAX_CLAIMS claims it is dropped
+FRONTIER_CLAIM_TTL = 300
+FRONTIER_MAX_CLAIMS = 3
+
+# house.leases.AreaLeases, nodes split main areas by leases that expire unless renewed,
+# areas of a crashed node are taken over once its leases expire
+LEASE_ENABLED = False
+LEASE_TTL = 300
+# areas crawled at once by one node, the rest wait until one is finished
+LEASE_MAX_AREAS = 4
+
+# house.digests.PageDigestCache, listing pages showing the same houses at the same prices
+# as last crawl emit no items, only their pagination is followed
+PAGE_DIGEST_ENABLED = False
+PAGE_DIGEST_FLUSH_SIZE = 500
+
+# incremental crawl, areas are paged INCREMENTAL_WINDOW pages ahead instead of all at once.
+# secondhand areas are sorted newest first by INCREMENTAL_SORT and stop at the first page holding only
+# known houses at unchanged prices (needs SECONDHAND_CHANGE_ONLY), sold areas stop at deals older
+# than the newest deal of the previous run, kept by house.watermarks.DealWatermarks
+INCREMENTAL_ENABLED = False
+INCREMENTAL_WINDOW = 2
+INCREMENTAL_SORT = 'co32'
+
+# areas listing more houses than the site pages through (PARTITION_MAX_PAGES pages) are split into
+# disjoint slices by sub area, then by PARTITION_PRICE_FILTERS, then PARTITION_ROOM_FILTERS until each fits
+PARTITION_ENABLED = True
+PARTITION_MAX_PAGES = 100
+PARTITION_PRICE_FILTERS = ['p1', 'p2', 'p3', 'p4', 'p5', 'p6', 'p7', 'p8']
+PARTITION_ROOM_FILTERS = ['l1', 'l2', 'l3', 'l4', 'l5', 'l6']
+
+# house.plans.CrawlPlan, the cities, navs and main areas a run found are kept in PLAN_FILE and the next
+# run requests the areas from it right away. cities older than PLAN_TTL seconds are walked again behind them
+PLAN_ENABLED = True
+PLAN_FILE = 'plan.json'
+PLAN_TTL = 86400
+
+# house.history.CrawlHistory, keep fingerprints of today's pages in a bloom filter,
+# the history table is only read when the filter reports a possible hit
+HISTORY_BLOOM_ENABLED = True
+HISTORY_BLOOM_CAPACITY = 100000
+HISTORY_BLOOM_ERROR_RATE = 0.001
+# recorded pages are written in batches, a crash loses at most HISTORY_MAX_UNFLUSHED of them
+# and they are crawled again on the next run
+HISTORY_MAX_UNFLUSHED = 1000
+HISTORY_FLUSH_INTERVAL = 5
 
 CAPTCHA_URL = 'captcha'
-# house.middlewares.RandomHttpProxyMiddleware
+# house.middlewares.RandomHttpProxyMiddleware, the proxy table is scanned in the background every
+# PROXIES_TIMEOUT seconds and kept in PROXY_CACHE_FILE, so a restart sends requests before hbase answers
 PROXIES_TIMEOUT = 60
+PROXY_CACHE_FILE = 'proxies.json'
+# download slot per proxy instead of per domain, each proxy gets its own concurrency and delay
+# and throughput grows with the pool up to CONCURRENT_REQUESTS
+PROXY_SLOTS_ENABLED = True
+PROXY_CONCURRENCY = 2
+PROXY_DOWNLOAD_DELAY = 2
 # house.middlewares.ProxyTimeoutMiddleware
 PROXY_RETRY_TIMES = 2
+# house.proxies.ProxyPool, proxies are picked by success rate and latency (seconds, scale of the ewma),
+# captchas and repeated failures quarantine a proxy for PROXY_QUARANTINE_TIME doubling with every strike,
+# it comes back on probation and is deleted after PROXY_MAX_STRIKES quarantines
+PROXY_LATENCY_SCALE = 2.0
+PROXY_MAX_FAILURES = 3
+PROXY_QUARANTINE_TIME = 60
+PROXY_PROBATION = 3
+PROXY_MAX_STRIKES = 5
+# house.commands.checkproxy, fetch PROXY_CHECK_URL through every proxy, an url echoing
+# the request headers (httpbin /get or a local server) also tells how anonymous a proxy is
+PROXY_CHECK_URL = 'http://httpbin.org/get'
+PROXY_CHECK_CONCURRENCY = 500
+PROXY_CHECK_TIMEOUT = 5
 # house.extensions.IdleSpider
 IDLESPIDER_TIMEOUT = 90
 #house.extensions.SparkStreamingExt
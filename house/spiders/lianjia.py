@@ -5,15 +5,26 @@ __author__ = 'sosozhuang'
 
 import json
 import logging
+import re
 from urlparse import urljoin
 
+from scrapy.exceptions import IgnoreRequest
 from scrapy.http import Request
 from scrapy.selector import Selector
 from scrapy.spiders import Spider
 from scrapy.utils.response import get_base_url
 
+from house.digests import PageDigestCache
+from house.extractors import secondhand_cards, sold_cards, sub_areas, total_count
+from house.index import LastSeenIndex
+from house.leases import AreaLeases
 from house.items import SecondhandHouseItem, NewHouseItem, SoldHouseItem
-from house.loaders import SecondhandHouseLoader, NewHouseLoader, SoldHouseLoader
+from house.loaders import SecondhandHouseLoader, NewHouseLoader, SoldHouseLoader, \
+    normalize_secondhand, normalize_sold, filter_deal
+from house.plans import CrawlPlan
+from house.watermarks import DealWatermarks
+
+deal_date = re.compile(r'\d{4}-\d{2}-\d{2}$')
 
 
 class LianjiaSpider(Spider):
@@ -23,11 +34,262 @@ class LianjiaSpider(Spider):
     target_cities = [u'北京', u'广州', u'深圳']
                     # u'厦门', u'杭州', u'成都',
                     # u'武汉', u'重庆', u'南京']
+    # navigation of cities seeded from an outdated plan is walked again behind the listing pages
+    refresh_priority = -10
 
     def __init__(self):
         self.target_navs = {u'二手房': (self.parse_seconhand_house_area, ''),
                             u'新房1': (self.parse_new_house_page, '/loupan')}
         self.crawled_day = datetime.datetime.now().strftime('%y%m%d')
+        # incremental crawl state per (city, kind, area slice)
+        self.stopped_areas = set()
+        self.last_pages = {}
+        self.newest_deals = {}
+        # per watermark key the sold pages parsed (True) or lost (False), and the page the area stops at
+        self.deal_pages = {}
+        self.deal_stops = {}
+        # (kind, house id) of houses from partitioned areas
+        self.sliced_ids = set()
+        # cities and (city, nav) or (city, kind, main area) requested from the crawl plan
+        self.planned_cities = set()
+        self.seeded = set()
+
+    @classmethod
+    def from_crawler(cls, crawler, *args, **kwargs):
+        spider = super(LianjiaSpider, cls).from_crawler(crawler, *args, **kwargs)
+        settings = crawler.settings
+        spider.leases = AreaLeases.from_crawler(crawler) if settings.getbool('LEASE_ENABLED') else None
+        spider.digests = PageDigestCache.from_crawler(crawler) \
+            if settings.getbool('PAGE_DIGEST_ENABLED') else None
+        spider.incremental = settings.getbool('INCREMENTAL_ENABLED')
+        spider.window = max(settings.getint('INCREMENTAL_WINDOW', 2), 1)
+        spider.sort = settings.get('INCREMENTAL_SORT', 'co32')
+        spider.last_seen = spider.watermarks = None
+        if spider.incremental:
+            spider.watermarks = DealWatermarks.from_crawler(crawler)
+            # loaded by SecondhandHousePipeline before the first page is parsed
+            if settings.getbool('SECONDHAND_CHANGE_ONLY'):
+                spider.last_seen = LastSeenIndex.from_crawler(crawler)
+            else:
+                spider.log('SECONDHAND_CHANGE_ONLY is off, secondhand areas only stop at pages '
+                           'PAGE_DIGEST_ENABLED finds unchanged.', logging.WARN)
+        spider.partition_enabled = settings.getbool('PARTITION_ENABLED')
+        spider.max_pages = settings.getint('PARTITION_MAX_PAGES', 100)
+        spider.price_filters = settings.getlist('PARTITION_PRICE_FILTERS')
+        spider.room_filters = settings.getlist('PARTITION_ROOM_FILTERS')
+        spider.plan = CrawlPlan.from_crawler(crawler) if settings.getbool('PLAN_ENABLED') else None
+        return spider
+
+    def start_requests(self):
+        if self.plan is not None:
+            for city in self.target_cities:
+                for request in self.plan_requests(city):
+                    yield request
+            if self.planned_cities:
+                self.log('Seeded %d requests of %d cities from the crawl plan.'
+                         % (len(self.seeded), len(self.planned_cities)), logging.INFO)
+                self.crawler.stats.set_value('plan/seeded', len(self.seeded))
+            if all(c in self.planned_cities and self.plan.fresh(c) for c in self.target_cities):
+                return
+        for request in super(LianjiaSpider, self).start_requests():
+            yield request
+
+    def plan_requests(self, city):
+        plan = self.plan.get(city)
+        # sold areas are only linked from the secondhand area index, a plan without both cant skip it
+        if plan is None or not (self.plan.areas(city, 'secondhand') and self.plan.areas(city, 'sold')):
+            return []
+        requests = []
+        for text, url in plan['navs'].items():
+            # secondhand areas are in the plan, their index page is not needed
+            callback = self.target_navs[text][0] if text in self.target_navs else None
+            if callback is not None and callback != self.parse_seconhand_house_area:
+                requests.append(Request(url=url, meta={'city': city}, callback=callback))
+                self.seeded.add((city, text))
+        for kind in ('secondhand', 'sold'):
+            areas = self.plan.areas(city, kind)
+            requests.extend(self.area_requests(city, kind, areas))
+            self.seeded.update((city, kind, area) for area, _ in areas)
+        self.planned_cities.add(city)
+        return requests
+
+    def area_requests(self, city, kind, areas):
+        callback = self.parse_secondhand_house_page if kind == 'secondhand' else self.parse_sold_house_page
+        requests = [Request(url=self.slice_url(url, (), kind),
+                            meta={'city': city, 'main_area': area, 'area_url': url},
+                            callback=callback)
+                    for area, url in areas if (city, kind, area) not in self.seeded]
+        return self.lease_areas(requests, kind)
+
+    def record_pages(self, response, page, kind):
+        # page counts of main areas, the next run requests the biggest ones first
+        if self.plan is not None and page is not None and page['curPage'] == 1 and 'filters' not in response.meta:
+            self.plan.record_pages(response.meta['city'], kind, response.meta['main_area'], page['totalPage'])
+
+    def page_digest(self, houses):
+        if self.digests is None or not houses:
+            return None
+        return self.digests.digest((h['id'], h['total'], h['unit']) for h in houses)
+
+    def next_pages(self, response, page, kind, stop=False):
+        # a full crawl schedules every page from the first one. an incremental one keeps window pages
+        # ahead, each page scheduling the one window pages after it, until a page without news stops the area
+        cur_page, total_page = page['curPage'], page['totalPage']
+        if not self.incremental:
+            return range(cur_page + 1, total_page + 1) if cur_page == 1 else []
+        area = (response.meta['city'], kind, self.slice_name(response.meta))
+        if area in self.stopped_areas:
+            return []
+        if stop:
+            self.stopped_areas.add(area)
+            self.log('Stop %s area %s at page %d of %d.' % (kind, area[2], cur_page, total_page), logging.DEBUG)
+            self.crawler.stats.inc_value('incremental/stopped_areas')
+            self.crawler.stats.inc_value('incremental/skipped_pages',
+                                         max(total_page - self.last_pages.get(area, cur_page), 0))
+            return []
+        return self.chain_pages(area, cur_page, total_page)
+
+    def chain_pages(self, area, cur_page, total_page):
+        if area in self.stopped_areas:
+            return []
+        if cur_page == 1:
+            pages = range(2, min(1 + self.window, total_page) + 1)
+        else:
+            pages = [cur_page + self.window] if cur_page + self.window <= total_page else []
+        if pages:
+            self.last_pages[area] = max(pages[-1], self.last_pages.get(area, 0))
+        return pages
+
+    def page_lost(self, failure):
+        # a page crawled earlier today, ignored or failed still schedules the one window pages after it,
+        # the chain of an incremental area would end there otherwise
+        request = failure.request
+        meta = request.meta
+        kind, page_url, cur_page, total_page = meta['page']
+        if failure.check(IgnoreRequest):
+            self.log('Lost %s page %s: %s' % (kind, request.url, failure.getErrorMessage()), logging.DEBUG)
+            self.crawler.stats.inc_value('incremental/ignored_pages')
+        else:
+            self.log('Lost %s page %s: %s' % (kind, request.url, failure.getErrorMessage()), logging.WARN)
+            self.crawler.stats.inc_value('incremental/failed_pages')
+        if kind == 'sold' and self.watermarks is not None:
+            self.deal_page(self.watermarks.key(meta['city'], self.slice_name(meta)), cur_page, False)
+        pages = self.chain_pages((meta['city'], kind, self.slice_name(meta)), cur_page, total_page)
+        for r in self.page_requests(request.url, meta, page_url, pages, request.callback, kind, total_page):
+            yield r
+        # AreaLeaseMiddleware leaves requests with an errback to it
+        if self.leases is not None:
+            self.leases.finished(request)
+
+    def deal_page(self, area_key, cur_page, parsed, stop=None):
+        # the watermark only moves once every page down to the one the area stops at was parsed,
+        # the deals of a lost page in between would never be crawled otherwise
+        pages = self.deal_pages.setdefault(area_key, {})
+        pages[cur_page] = parsed
+        if stop is not None:
+            self.deal_stops[area_key] = min(stop, self.deal_stops.get(area_key, stop))
+        stop = self.deal_stops.get(area_key)
+        if stop is not None and all(pages.get(i) for i in range(1, stop + 1)):
+            self.watermarks.advance(area_key, self.newest_deals.get(area_key))
+
+    def page_info(self, response, sel):
+        page_box = sel.xpath('//div[@class="page-box house-lst-page-box"]')
+        page_url = page_box.xpath('@page-url').extract_first()
+        if not page_url:
+            self.log('Crawled %s cant find page url.' % response.url, logging.WARN)
+            return None, None
+        page_data = page_box.xpath('@page-data').extract_first()
+        if not page_data:
+            self.log('Crawled %s cant find page data.' % response.url, logging.WARN)
+            return None, None
+        return page_url, json.loads(page_data)
+
+    def slice_url(self, area_url, filters, kind):
+        segment = ''.join(filters)
+        if self.incremental and kind == 'secondhand':
+            # newest listings first, an incremental crawl stops where the known ones start
+            segment = self.sort + segment
+        return urljoin(area_url, segment + '/') if segment else area_url
+
+    def slice_name(self, meta):
+        name = meta['main_area']
+        if meta.get('sub_area'):
+            name += u'/' + meta['sub_area']
+        if meta.get('filters'):
+            name += u'/' + u''.join(meta['filters'])
+        return name
+
+    def partition(self, response, sel, page, page_size, kind, callback):
+        # the site pages through max_pages pages of an area only, a larger one is split into disjoint
+        # slices by sub area, then price band, then room count and the slices are split again if needed
+        if not self.partition_enabled or page is None or page['curPage'] != 1:
+            return None
+        count = total_count(sel)
+        if count is None:
+            oversized = page['totalPage'] >= self.max_pages
+        else:
+            oversized = count > self.max_pages * page_size
+        if not oversized:
+            return None
+
+        meta = response.meta
+        filters = tuple(meta.get('filters', ()))
+        base = {'city': meta['city'], 'main_area': meta['main_area'], 'sub_area': meta.get('sub_area'),
+                'area_url': meta.get('area_url', response.url), 'filters': filters}
+        if 'area_lease' in meta:
+            base['area_lease'] = meta['area_lease']
+        slices = []
+        if not meta.get('sub_area'):
+            subs = sub_areas(sel)
+            if len(subs) > 1:
+                base_url = get_base_url(response)
+                slices = [dict(base, sub_area=name, area_url=urljoin(base_url, href)) for name, href in subs]
+        if not slices:
+            for dimension in (self.price_filters, self.room_filters):
+                if dimension and not set(dimension) & set(filters):
+                    slices = [dict(base, filters=filters + (f,)) for f in dimension]
+                    break
+        if not slices:
+            self.log('Crawled %s lists %s houses, cant split it further.' % (response.url, count), logging.WARN)
+            self.crawler.stats.inc_value('partition/truncated')
+            return None
+        self.log('Split %s area %s of %s houses into %d slices.' % (kind, self.slice_name(meta), count, len(slices)),
+                 logging.DEBUG)
+        self.crawler.stats.inc_value('partition/splits')
+        self.crawler.stats.inc_value('partition/slices', len(slices))
+        return [Request(url=self.slice_url(m['area_url'], m['filters'], kind), meta=m, callback=callback)
+                for m in slices]
+
+    def duplicate(self, response, kind, house_id):
+        # a house listed in two sub areas of a partitioned area is emitted once
+        if 'filters' not in response.meta:
+            return False
+        key = (kind, house_id)
+        if key in self.sliced_ids:
+            self.crawler.stats.inc_value('partition/duplicates')
+            return True
+        self.sliced_ids.add(key)
+        return False
+
+    def page_requests(self, base_url, meta, page_url, pages, callback, kind, total_page):
+        # pages crawled today are dropped by IgnoreRequestMiddleware, it looks them up in batches
+        meta = dict(meta)
+        meta['check_crawled'] = True
+        meta['suffix'] = self.crawled_day
+        return [Request(url=urljoin(base_url, page_url.replace('{page}', '%d' % i)),
+                        meta=dict(meta, page=(kind, page_url, i, total_page)),
+                        callback=callback,
+                        errback=self.page_lost if self.incremental else None)
+                for i in pages]
+
+    def lease_areas(self, requests, kind):
+        if self.leases is None:
+            return requests
+        for r in requests:
+            r.meta['area_lease'] = self.leases.key(r.meta['city'], kind, r.meta['main_area'])
+        # the leases hand the areas they win to the engine
+        self.leases.claim(requests)
+        return []
 
     def parse(self, response):
         sel = Selector(response)
@@ -38,9 +300,15 @@ class LianjiaSpider(Spider):
             return
         links = navs.xpath('@href').extract()
         for city in self.target_cities:
+            priority = 0
+            if city in self.planned_cities:
+                if self.plan.fresh(city):
+                    continue
+                priority = self.refresh_priority
             yield Request(url='http:' + links[cities.index(city)],
                           meta={'city': city, 'dont_redirect': True, 'handle_httpstatus_list': [302]},
-                          callback=self.parse_city)
+                          callback=self.parse_city,
+                          priority=priority)
 
     def parse_city(self, response):
         sel = Selector(response)
@@ -48,11 +316,18 @@ class LianjiaSpider(Spider):
         links = navs.xpath('@href').extract()
         texts = navs.xpath('text()').extract()
 
+        city = response.meta['city']
         for i, j in enumerate(texts):
             if j in self.target_navs:
-                yield Request(url=urljoin(links[i], self.target_navs[j][1]),
-                              meta={'city': response.meta['city']},
-                              callback=self.target_navs[j][0])
+                url = urljoin(links[i], self.target_navs[j][1])
+                if self.plan is not None:
+                    self.plan.record_nav(city, j, url)
+                if (city, j) in self.seeded:
+                    continue
+                yield Request(url=url,
+                              meta={'city': city},
+                              callback=self.target_navs[j][0],
+                              priority=response.request.priority)
 
     def parse_seconhand_house_area(self, response):
         sel = Selector(response)
@@ -64,73 +339,71 @@ class LianjiaSpider(Spider):
         sold_url = sel.xpath('//div[@class="menu"]//ul[@class="typeList"]/li[2]/a/@href').extract_first()
         yield Request(url=urljoin(base_url, sold_url),
                       meta=response.meta,
-                      callback=self.parse_sold_house_area)
+                      callback=self.parse_sold_house_area,
+                      priority=response.request.priority)
 
-        for i, area in enumerate(areas):
-            yield Request(url=urljoin(base_url, links[i]),
-                          meta={'city': response.meta['city'], 'main_area': area},
-                          callback=self.parse_secondhand_house_page)
+        areas = [(area, urljoin(base_url, links[i])) for i, area in enumerate(areas)]
+        if self.plan is not None:
+            self.plan.record_areas(response.meta['city'], 'secondhand', areas)
+        # areas seeded from the plan are requested already, new ones are not
+        for request in self.area_requests(response.meta['city'], 'secondhand', areas):
+            yield request
 
     def parse_secondhand_house_page(self, response):
         sel = Selector(response)
 
-        titles = sel.xpath('//div[@class="title"]/a/text()').extract()
-        house_infos = sel.xpath('//div[@class="address"]/div[@class="houseInfo"]')
-        communities = house_infos.xpath('a/text()').extract()
-        infos = house_infos.xpath('text()').extract()
-        built_years = sel.xpath('//div[@class="flood"]/div[@class="positionInfo"]/text()').extract()
-        sub_areas = sel.xpath('//div[@class="flood"]/div[@class="positionInfo"]/a/text()').extract()
-        tag_path = sel.xpath('//div[@class="tag"]')
-        tags = [tag.xpath('span/@class').extract() for tag in tag_path]
-        price_infos = sel.xpath('//div[@class="priceInfo"]')
-        totals = price_infos.xpath('div[@class="totalPrice"]/span/text()').extract()
-        units = price_infos.xpath('div[@class="unitPrice"]/@data-price').extract()
-        ids = price_infos.xpath('div[@class="unitPrice"]/@data-hid').extract()
-
-        attrs = [titles, communities, infos, built_years, sub_areas, tags, totals, units, ids]
-        min_length = min(len(i) for i in attrs)
-        if min_length <= 0:
+        houses = secondhand_cards.extract(sel)
+        if not houses:
             self.log('Crawled %s cant find any house info.' % response.url, logging.WARN)
             return
-        for i in range(0, min_length):
-            loader = SecondhandHouseLoader(item=SecondhandHouseItem())
-            loader.add_value('city', response.meta['city'])
-            loader.add_value('title', titles[i])
-            room, space = infos[i].strip(' |').split('|')[:2]
-            loader.add_value('room', room)
-            loader.add_value('b_year', built_years[i])
-            loader.add_value('comm', communities[i])
-            loader.add_value('id', ids[i])
-            loader.add_value('main', response.meta['main_area'])
-            loader.add_value('sub', sub_areas[i])
-            loader.add_value('space', space)
-            # loader.add_value('listed', listed)
-            loader.add_value('tags', tags[i])
-            loader.add_value('total', totals[i])
-            loader.add_value('unit', units[i])
-            yield loader.load_item()
-
-        page_box = sel.xpath('//div[@class="page-box house-lst-page-box"]')
-        page_url = page_box.xpath('@page-url').extract_first()
-        if not page_url:
-            self.log('Crawled %s cant find page url' % response.url, logging.WARN)
+        page_url, page = self.page_info(response, sel)
+        self.record_pages(response, page, 'secondhand')
+        slices = self.partition(response, sel, page, len(houses), 'secondhand', self.parse_secondhand_house_page)
+        if slices:
+            # the slices list every house of this page again
+            for request in slices:
+                yield request
             return
-        page_data = page_box.xpath('@page-data').extract_first()
-        if not page_data:
-            self.log('Crawled %s cant find page data' % response.url, logging.WARN)
+        # same houses at the same prices as last crawl, only pagination is followed
+        digest = self.page_digest(houses)
+        stale = bool(digest) and self.digests.unchanged(response.url, digest)
+        if stale:
+            self.log('Skip unchanged page %s.' % response.url, logging.DEBUG)
+        else:
+            items = []
+            for house in houses:
+                if not house['info']:
+                    self.log('Crawled %s cant find info of house %s.' % (response.url, house['id']), logging.WARN)
+                    continue
+                room, space = (house['info'].strip(' |').split('|') + [None])[:2]
+                items.append(normalize_secondhand(city=response.meta['city'],
+                                                  title=house['title'],
+                                                  room=room,
+                                                  b_year=house['b_year'],
+                                                  comm=house['comm'],
+                                                  id=house['id'],
+                                                  main=response.meta['main_area'],
+                                                  sub=house['sub'],
+                                                  space=space,
+                                                  tags=house['tags'],
+                                                  total=house['total'],
+                                                  unit=house['unit']))
+            # checked before the pipeline sees this page and updates the index
+            if self.last_seen is not None:
+                stale = bool(items) and all(self.last_seen.unchanged(i.get('id'), i.get('total'), i.get('unit'))
+                                            for i in items)
+            for item in items:
+                if not self.duplicate(response, 'secondhand', item.get('id')):
+                    yield item
+            if digest:
+                self.digests.record(response.url, digest)
+
+        if page is None:
             return
-        page = json.loads(page_data)
-        cur_page = page['curPage']
-        if cur_page == 1:
-            base_url = get_base_url(response)
-            meta = dict(response.meta)
-            meta['check_crawled'] = True
-            meta['suffix'] = self.crawled_day
-            for i in range(cur_page + 1, page['totalPage'] + 1):
-                u = urljoin(base_url, page_url.replace('{page}', '%d' % i))
-                yield Request(url=u,
-                              meta=meta,
-                              callback=self.parse_secondhand_house_page)
+        pages = self.next_pages(response, page, 'secondhand', stop=stale)
+        for request in self.page_requests(get_base_url(response), response.meta, page_url, pages,
+                                          self.parse_secondhand_house_page, 'secondhand', page['totalPage']):
+            yield request
 
     def parse_sold_house_area(self, response):
         sel = Selector(response)
@@ -139,73 +412,74 @@ class LianjiaSpider(Spider):
         links = sel.xpath('//div[@data-role="ershoufang"]//a/@href').extract()
         base_url = get_base_url(response)
 
-        for i, area in enumerate(areas):
-            yield Request(url=urljoin(base_url, links[i]),
-                          meta={'city': response.meta['city'], 'main_area': area},
-                          callback=self.parse_sold_house_page)
+        areas = [(area, urljoin(base_url, links[i])) for i, area in enumerate(areas)]
+        if self.plan is not None:
+            self.plan.record_areas(response.meta['city'], 'sold', areas)
+        for request in self.area_requests(response.meta['city'], 'sold', areas):
+            yield request
 
     def parse_sold_house_page(self, response):
         sel = Selector(response)
 
-        house_links = sel.xpath('//div[@class="title"]/a/@href').extract()
-        house_ids = [link.split('/')[-1].split('.')[0] for link in house_links]
-        titles = sel.xpath('//div[@class="title"]/a/text()').extract()
-        content = sel.xpath('//ul[@class="listContent"]')
-        address = content.xpath('.//div[@class="address"]')
-        house_infos = address.xpath('div[@class="houseInfo"]/text()').extract()
-        deals = address.xpath('div[@class="dealDate"]/text()').extract()
-        totals = address.xpath('div[@class="totalPrice"]/span/text()').extract()
-        flood = content.xpath('.//div[@class="flood"]')
-        built_years = flood.xpath('div[@class="positionInfo"]/text()').extract()
-        units = flood.xpath('div[@class="unitPrice"]/span/text()').extract()
-        hangs = content.xpath('.//div[@class="dealCycleeInfo"]/span[@class="dealCycleTxt"]/span[1]/text()').extract()
-        periods = content.xpath('.//div[@class="dealCycleeInfo"]/span[@class="dealCycleTxt"]/span[2]/text()').extract()
-
-        attrs = [house_ids, titles, house_infos, deals, totals, built_years, units, hangs, periods]
-        min_length = min(len(i) for i in attrs)
-        if min_length <= 0:
+        houses = sold_cards.extract(sel)
+        if not houses:
             self.log('Crawled %s cant find house infos.' % response.url, logging.WARN)
             return
-        for i in range(0, min_length):
-            loader = SoldHouseLoader(item=SoldHouseItem())
-            loader.add_value('city', response.meta['city'])
-            loader.add_value('main', response.meta['main_area'])
-            community, room, space = titles[i].split()[:3]
-            loader.add_value('comm', community)
-            loader.add_value('info', house_infos[i])
-            loader.add_value('deal', deals[i])
-            loader.add_value('total', totals[i])
-            loader.add_value('unit', units[i])
-            loader.add_value('hang', hangs[i])
-            loader.add_value('period', periods[i])
-            # loader.add_value('browse', browse)
-            loader.add_value('room', room)
-            loader.add_value('space', space)
-            loader.add_value('b_year', built_years[i])
-            loader.add_value('id', house_ids[i])
-            yield loader.load_item()
-
-        page_box = sel.xpath('//div[@class="page-box house-lst-page-box"]')
-        page_url = page_box.xpath('@page-url').extract_first()
-        if not page_url:
-            self.log('Crawled %s cant find page url.' % response.url, logging.WARN)
+        page_url, page = self.page_info(response, sel)
+        self.record_pages(response, page, 'sold')
+        slices = self.partition(response, sel, page, len(houses), 'sold', self.parse_sold_house_page)
+        if slices:
+            for request in slices:
+                yield request
             return
-        page_data = page_box.xpath('@page-data').extract_first()
-        if not page_data:
-            self.log('Crawled %s cant find page data.' % response.url, logging.WARN)
+        # sold listings come newest deal first, older deals than the last run's newest are known
+        stale = False
+        if self.watermarks is not None:
+            area_key = self.watermarks.key(response.meta['city'], self.slice_name(response.meta))
+            # masked deal dates are no dates, they would end up as the watermark
+            deals = [d for d in (filter_deal(h['deal']).strip() for h in houses if h['deal']) if deal_date.match(d)]
+            if deals:
+                watermark = self.watermarks.get(area_key)
+                stale = watermark is not None and min(deals) < watermark
+                self.newest_deals[area_key] = max(max(deals), self.newest_deals.get(area_key))
+        # same houses at the same prices as last crawl, only pagination is followed
+        digest = self.page_digest(houses)
+        if digest and self.digests.unchanged(response.url, digest):
+            self.log('Skip unchanged page %s.' % response.url, logging.DEBUG)
+        else:
+            for house in houses:
+                if not house['title'] or len(house['title'].split()) < 3:
+                    self.log('Crawled %s cant find title of house %s.' % (response.url, house['id']), logging.WARN)
+                    continue
+                if self.duplicate(response, 'sold', house['id']):
+                    continue
+                community, room, space = house['title'].split()[:3]
+                yield normalize_sold(city=response.meta['city'],
+                                     main=response.meta['main_area'],
+                                     comm=community,
+                                     info=house['info'],
+                                     deal=house['deal'],
+                                     total=house['total'],
+                                     unit=house['unit'],
+                                     hang=house['hang'],
+                                     period=house['period'],
+                                     room=room,
+                                     space=space,
+                                     b_year=house['b_year'],
+                                     id=house['id'])
+            if digest:
+                self.digests.record(response.url, digest)
+
+        if page is None:
             return
-        page = json.loads(page_data)
-        cur_page = page['curPage']
-        if cur_page == 1:
-            base_url = get_base_url(response)
-            for i in range(cur_page + 1, page['totalPage'] + 1):
-                u = urljoin(base_url, page_url.replace('{page}', '%d' % i))
-                meta = dict(response.meta)
-                meta['check_crawled'] = True
-                meta['suffix'] = self.crawled_day
-                yield Request(url=u,
-                              meta=meta,
-                              callback=self.parse_sold_house_page)
+        if self.watermarks is not None:
+            # paged down to the old watermark, the area is complete up to its newest deal
+            cur_page = page['curPage']
+            self.deal_page(area_key, cur_page, True, cur_page if stale or cur_page >= page['totalPage'] else None)
+        pages = self.next_pages(response, page, 'sold', stop=stale)
+        for request in self.page_requests(get_base_url(response), response.meta, page_url, pages,
+                                          self.parse_sold_house_page, 'sold', page['totalPage']):
+            yield request
 
     def parse_new_house_page(self, response):
         sel = Selector(response)
@@ -404,21 +678,16 @@ class LianjiaSHSpider(Spider):
             self.log('Crawled page %s cant find any house info' % response.url, logging.WARN)
             return
         for i in range(0, min_length):
-            loader = SecondhandHouseLoader(item=SecondhandHouseItem())
-            loader.add_value('city', self.city)
-            loader.add_value('title', titles[i])
-            loader.add_value('room', rooms[i])
-            # loader.add_value('b_year', built_years[i])
-            loader.add_value('comm', communities[i])
-            loader.add_value('id', ids[i])
-            loader.add_value('main', main_areas[i])
-            loader.add_value('sub', sub_areas[i])
-            loader.add_value('space', spaces[i])
-            # loader.add_value('listed', listed)
-            # loader.add_value('tags', tags[i])
-            loader.add_value('total', totals[i])
-            loader.add_value('unit', units[i])
-            yield loader.load_item()
+            yield normalize_secondhand(city=self.city,
+                                       title=titles[i],
+                                       room=rooms[i],
+                                       comm=communities[i],
+                                       id=ids[i],
+                                       main=main_areas[i],
+                                       sub=sub_areas[i],
+                                       space=spaces[i],
+                                       total=totals[i],
+                                       unit=units[i])
 
         page_box = sel.xpath('//div[@class="c-pagination"]')
         cur_page = page_box.xpath('span[@class="current"]/text()').extract_first()
@@ -478,19 +747,17 @@ class LianjiaSHSpider(Spider):
             self.log('Crawled %s cant find any house info.' % response.url, logging.WARN)
             return
         for i in range(0, min_length):
-            loader = SoldHouseLoader(item=SoldHouseItem())
-            loader.add_value('city', self.city)
             room, space = titles[i].split()[:2]
-            loader.add_value('comm', communities[i])
-            loader.add_value('deal', deals[i])
-            loader.add_value('total', totals[i])
-            loader.add_value('unit', units[i])
-            loader.add_value('main', main_areas[i])
-            loader.add_value('sub', sub_areas[i])
-            loader.add_value('room', room)
-            loader.add_value('space', space)
-            loader.add_value('id', house_ids[i])
-            yield loader.load_item()
+            yield normalize_sold(city=self.city,
+                                 comm=communities[i],
+                                 deal=deals[i],
+                                 total=totals[i],
+                                 unit=units[i],
+                                 main=main_areas[i],
+                                 sub=sub_areas[i],
+                                 room=room,
+                                 space=space,
+                                 id=house_ids[i])
 
         page_box = sel.xpath('//div[@class="c-pagination"]')
         cur_page = page_box.xpath('span[@class="current"]/text()').extract_first()
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+import gzip
+import json
+import logging
+import os
+import socket
+import time
+
+from hbase import Hbase
+from scrapy import signals
+
+logger = logging.getLogger(__name__)
+
+
+def _encode(value):
+    return value.encode('utf-8') if isinstance(value, unicode) else value
+
+
+class SegmentWriter(object):
+    suffix = '.jl.gz'
+    partial = '.part'
+
+    def __init__(self, directory, prefix, segment_size=16 * 1024 * 1024, sync=True):
+        self.directory = directory
+        self.prefix = prefix
+        self.segment_size = segment_size
+        self.sync = sync
+        self.seq = 0
+        self.path = None
+        self.file = None
+        self.written = 0
+
+    def _open(self):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        self.seq += 1
+        name = '%s-%s-%s-%d-%06d%s' % (self.prefix, time.strftime('%Y%m%d%H%M%S'),
+                                       socket.gethostname(), os.getpid(), self.seq, self.suffix)
+        self.path = os.path.join(self.directory, name)
+        # segments stay hidden from readers until they are complete
+        self.file = gzip.open(self.path + self.partial, 'ab')
+        self.written = 0
+
+    def write(self, record):
+        if self.file is None:
+            self._open()
+        line = json.dumps(record) + '\n'
+        self.file.write(line)
+        if self.sync:
+            self.file.flush()
+            os.fsync(self.file.fileobj.fileno())
+        self.written += len(line)
+        if self.written >= self.segment_size:
+            self.rotate()
+
+    def rotate(self):
+        if self.file is not None:
+            self.file.close()
+            os.rename(self.path + self.partial, self.path)
+            self.file = None
+
+    def close(self):
+        self.rotate()
+
+    @classmethod
+    def segments(cls, directory, prefix, partial=False):
+        if not os.path.isdir(directory):
+            return []
+        suffixes = (cls.suffix, cls.suffix + cls.partial) if partial else (cls.suffix,)
+        return sorted(os.path.join(directory, name) for name in os.listdir(directory)
+                      if name.startswith(prefix + '-') and name.endswith(suffixes))
+
+    @classmethod
+    def read(cls, path):
+        f = gzip.open(path, 'rb')
+        try:
+            while True:
+                try:
+                    line = f.readline()
+                except (IOError, EOFError) as e:
+                    # a segment cut short by a crash is readable up to its last flush
+                    logger.warning('Segment %s truncated: %s', path, e)
+                    return
+                if not line:
+                    return
+                if line.endswith('\n'):
+                    yield json.loads(line)
+        finally:
+            f.close()
+
+
+class MutationSpool(SegmentWriter):
+    def __init__(self, directory, segment_size=16 * 1024 * 1024, stats=None):
+        super(MutationSpool, self).__init__(directory, 'mutations', segment_size)
+        self.stats = stats
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        spool = getattr(crawler, 'mutation_spool', None)
+        if spool is None:
+            spool = cls(crawler.settings.get('SPOOL_DIR', 'spool'),
+                        crawler.settings.getint('SPOOL_SEGMENT_SIZE', 16 * 1024 * 1024),
+                        crawler.stats)
+            crawler.mutation_spool = spool
+            crawler.signals.connect(spool.close, signal=signals.engine_stopped)
+        return spool
+
+    def write_batch(self, table, batch_mutations):
+        rows = [[b.row, [[m.column, m.value, m.isDelete] for m in b.mutations]] for b in batch_mutations]
+        self.write({'table': table, 'rows': rows})
+        if self.stats:
+            self.stats.inc_value('spool/%s/rows' % table, len(rows))
+
+    @classmethod
+    def read_batches(cls, path):
+        for record in cls.read(path):
+            batch_mutations = [Hbase.BatchMutation(row=_encode(row), mutations=[
+                Hbase.Mutation(column=_encode(column), value=_encode(value), isDelete=is_delete)
+                for column, value, is_delete in mutations]) for row, mutations in record['rows']]
+            yield _encode(record['table']), batch_mutations
@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+import re
+import sqlite3
+import threading
+import time
+from itertools import groupby
+
+from hbase import Hbase
+
+from house.storage import Backend, StorageUnavailable, Table
+
+
+class SqliteWrapper(Table):
+    def __init__(self, backend, table=None):
+        super(SqliteWrapper, self).__init__(backend, table)
+        self.name = '"%s"' % table.replace('"', '""')
+        self.ttls = {}
+
+    def _create_table(self, column_families, split_keys=None):
+        for cf in column_families:
+            if cf.timeToLive and cf.timeToLive > 0:
+                self.ttls[cf.name.rstrip(':')] = cf.timeToLive
+        self.backend.execute('CREATE TABLE IF NOT EXISTS %s ('
+                             'row TEXT NOT NULL, col TEXT NOT NULL, value BLOB, ts INTEGER NOT NULL, '
+                             'PRIMARY KEY (row, col)) WITHOUT ROWID' % self.name)
+
+    def _mutate(self, cursor, row_key, mutations, ts):
+        for m in mutations:
+            if m.isDelete:
+                cursor.execute('DELETE FROM %s WHERE row = ? AND col = ?' % self.name, (row_key, m.column))
+            else:
+                cursor.execute('INSERT OR REPLACE INTO %s VALUES (?, ?, ?, ?)' % self.name,
+                               (row_key, m.column, m.value, ts))
+
+    def put(self, row_key, mutations):
+        self.put_rows([self.batch_mutation(row_key, mutations)])
+
+    def put_rows(self, batch_mutations):
+        ts = int(time.time() * 1000)
+        with self.backend.transaction() as cursor:
+            for b in batch_mutations:
+                self._mutate(cursor, b.row, b.mutations, ts)
+
+    def _matcher(self, columns):
+        if not columns:
+            return lambda col: True
+        columns = set(columns)
+        families = set(c.rstrip(':') for c in columns if ':' not in c.rstrip(':'))
+        return lambda col: col in columns or col.split(':', 1)[0] in families
+
+    def _rows(self, cells, columns):
+        match = self._matcher(columns)
+        now = int(time.time() * 1000)
+        rows = []
+        for row, col, value, ts in cells:
+            ttl = self.ttls.get(col.split(':', 1)[0])
+            if not match(col) or (ttl and now - ts > ttl * 1000):
+                continue
+            if not rows or rows[-1].row != row:
+                rows.append(Hbase.TRowResult(row=row, columns={}))
+            rows[-1].columns[col] = Hbase.TCell(value=value, timestamp=ts)
+        return rows
+
+    def get(self, row_key, columns):
+        return self.get_rows([row_key], columns)
+
+    def get_rows(self, row_keys, columns):
+        if not row_keys:
+            return []
+        cells = self.backend.query('SELECT row, col, value, ts FROM %s WHERE row IN (%s) ORDER BY row, col'
+                                   % (self.name, ', '.join('?' * len(row_keys))), row_keys)
+        return self._rows(cells, columns)
+
+    def delete(self, row_key):
+        with self.backend.transaction() as cursor:
+            cursor.execute('DELETE FROM %s WHERE row = ?' % self.name, (row_key,))
+
+    def check_and_put(self, row_key, column, value, mutation):
+        now = int(time.time() * 1000)
+        ttl = self.ttls.get(column.split(':', 1)[0])
+        with self.backend.transaction() as cursor:
+            # the delete takes the write lock, so no other process can slip in between check and put
+            cursor.execute('DELETE FROM %s WHERE row = ? AND col = ? AND ts < ?' % self.name,
+                           (row_key, column, now - ttl * 1000 if ttl else 0))
+            cursor.execute('SELECT value FROM %s WHERE row = ? AND col = ?' % self.name, (row_key, column))
+            current = cursor.fetchone()
+            if (current[0] if current else None) != value:
+                return False
+            self._mutate(cursor, row_key, (mutation,), now)
+            return True
+
+    def _cells(self, start_row, stop_row, batch_size):
+        last_row, last_col = start_row, ''
+        stop = 'AND row < ?' if stop_row is not None else ''
+        while True:
+            # keyset paging keeps one chunk of cells in memory at a time
+            args = (last_row, last_row, last_col) + ((stop_row,) if stop else ()) + (batch_size,)
+            cells = self.backend.query('SELECT row, col, value, ts FROM %s WHERE (row > ? OR (row = ? AND col > ?)) %s '
+                                       'ORDER BY row, col LIMIT ?' % (self.name, stop), args)
+            if not cells:
+                return
+            for cell in cells:
+                yield cell
+            last_row, last_col = cells[-1][0], cells[-1][1]
+
+    def scan(self, start_row='', stop_row=None, prefix=None, columns=None, row_regex=None, batch_size=None):
+        start_row, stop_row, batch_size = self._scan_range(start_row, stop_row, prefix, batch_size)
+        cells = self._cells(start_row, stop_row, batch_size)
+        if row_regex:
+            pattern = re.compile(row_regex)
+            cells = (c for c in cells if pattern.search(c[0]))
+        for _, row_cells in groupby(cells, key=lambda c: c[0]):
+            rows = self._rows(row_cells, columns)
+            if rows:
+                yield rows[0]
+
+
+class SqliteBackend(Backend):
+    table_class = SqliteWrapper
+
+    def __init__(self, path='house.db', size=4, timeout=30, max_inflight=100, scan_batch_size=1000,
+                 salt_buckets=None, stats=None):
+        super(SqliteBackend, self).__init__(size, max_inflight, scan_batch_size, salt_buckets, stats)
+        self.path = path
+        self.timeout = timeout
+        self.local = threading.local()
+        self.connections = []
+
+    @classmethod
+    def from_settings(cls, settings, stats=None):
+        return cls(
+            path=settings.get('SQLITE_PATH', 'house.db'),
+            size=settings.getint('SQLITE_POOL_SIZE', 4),
+            timeout=settings.getfloat('SQLITE_TIMEOUT', 30),
+            max_inflight=settings.getint('STORAGE_MAX_INFLIGHT', 100),
+            scan_batch_size=settings.getint('STORAGE_SCAN_BATCH_SIZE', 1000),
+            salt_buckets=settings.getdict('STORAGE_SALT_BUCKETS'),
+            stats=stats
+        )
+
+    def connection(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=self.timeout, check_same_thread=False)
+            connection.text_factory = str
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self.local.connection = connection
+            with self.lock:
+                self.connections.append(connection)
+        return connection
+
+    def transaction(self):
+        return _Transaction(self.connection())
+
+    def execute(self, sql, args=()):
+        with self.transaction() as cursor:
+            cursor.execute(sql, args)
+
+    def query(self, sql, args=()):
+        try:
+            return self.connection().execute(sql, args).fetchall()
+        except sqlite3.OperationalError as e:
+            raise StorageUnavailable('%s: %s' % (self.path, e))
+
+    def close(self):
+        super(SqliteBackend, self).close()
+        with self.lock:
+            for connection in self.connections:
+                connection.close()
+            self.connections = []
+        self.local = threading.local()
+
+
+class _Transaction(object):
+    def __init__(self, connection):
+        self.connection = connection
+        self.cursor = None
+
+    def __enter__(self):
+        self.cursor = self.connection.cursor()
+        return self.cursor
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None:
+                self.connection.commit()
+            else:
+                self.connection.rollback()
+        finally:
+            self.cursor.close()
+        if isinstance(exc_value, sqlite3.OperationalError):
+            # a locked or unreachable database is treated like an hbase outage
+            raise StorageUnavailable('%s: %s' % (self.connection, exc_value))
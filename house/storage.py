@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+import heapq
+import threading
+import zlib
+
+from hbase import Hbase
+from scrapy import signals
+from scrapy.utils.misc import load_object
+from twisted.internet import defer, reactor, threads
+from twisted.python.threadpool import ThreadPool
+
+
+class StorageUnavailable(Exception):
+    pass
+
+
+def backend_from_crawler(crawler):
+    backend = getattr(crawler, 'storage', None)
+    if backend is None:
+        backend_cls = load_object(crawler.settings.get('STORAGE_BACKEND', 'house.hbase_wrapper.HbasePool'))
+        backend = backend_cls.from_settings(crawler.settings, crawler.stats)
+        crawler.storage = backend
+        crawler.signals.connect(backend.close, signal=signals.engine_stopped)
+    return backend
+
+
+def prefix_stop_row(prefix):
+    # the first row key sorting after every key that starts with prefix
+    prefix = prefix.rstrip('\xff')
+    if not prefix:
+        return None
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+def backend_from_settings(settings):
+    backend_cls = load_object(settings.get('STORAGE_BACKEND', 'house.hbase_wrapper.HbasePool'))
+    return backend_cls.from_settings(settings)
+
+
+class Backend(object):
+    table_class = None
+
+    def __init__(self, size=10, max_inflight=100, scan_batch_size=1000, salt_buckets=None, stats=None):
+        self.size = size
+        self.scan_batch_size = scan_batch_size
+        self.salt_buckets = salt_buckets or {}
+        self.stats = stats
+        self.tables = {}
+        self.lock = threading.Lock()
+        # one worker per connection, calls past max_inflight wait in the reactor
+        self.threadpool = None
+        self.inflight = defer.DeferredSemaphore(max_inflight)
+
+    @classmethod
+    def from_settings(cls, settings, stats=None):
+        raise NotImplementedError
+
+    def table(self, name):
+        with self.lock:
+            if name not in self.tables:
+                table = self.table_class(self, name)
+                buckets = int(self.salt_buckets.get(name, 0))
+                self.tables[name] = SaltedTable(table, buckets) if buckets > 1 else table
+            return self.tables[name]
+
+    def defer(self, func, *args, **kwargs):
+        if self.threadpool is None:
+            self.threadpool = ThreadPool(minthreads=1, maxthreads=self.size, name=type(self).__name__)
+            self.threadpool.start()
+        return self.inflight.run(threads.deferToThreadPool, reactor, self.threadpool, func, *args, **kwargs)
+
+    def close(self):
+        if self.threadpool is not None:
+            self.threadpool.stop()
+            self.threadpool = None
+
+
+class Table(object):
+    def __init__(self, backend, table=None):
+        if not isinstance(table, str):
+            raise TypeError('table must be type str')
+        self.backend = backend
+        self.table = table
+        self.bootstrapped = False
+        self.lock = threading.Lock()
+
+    def create_table_if_not_exists(self, column_families, split_keys=None):
+        with self.lock:
+            if not self.bootstrapped:
+                self._create_table(column_families, split_keys)
+                self.bootstrapped = True
+
+    def _create_table(self, column_families, split_keys=None):
+        raise NotImplementedError
+
+    @classmethod
+    def column(cls, column_family, qualifier):
+        return '%s:%s' % (column_family, qualifier)
+
+    @classmethod
+    def mutation(cls, column_family, qualifier, value=None):
+        return Hbase.Mutation(column=cls.column(column_family, qualifier), value=value)
+
+    @classmethod
+    def batch_mutation(cls, row_key, mutations):
+        return Hbase.BatchMutation(row=row_key, mutations=mutations)
+
+    def put(self, row_key, mutations):
+        raise NotImplementedError
+
+    def put_rows(self, batch_mutations):
+        raise NotImplementedError
+
+    def get(self, row_key, columns):
+        raise NotImplementedError
+
+    def get_rows(self, row_keys, columns):
+        raise NotImplementedError
+
+    def delete(self, row_key):
+        raise NotImplementedError
+
+    def check_and_put(self, row_key, column, value, mutation):
+        # apply mutation only if column holds value, None meaning the column is absent
+        raise NotImplementedError
+
+    def scan(self, start_row='', stop_row=None, prefix=None, columns=None, row_regex=None, batch_size=None):
+        raise NotImplementedError
+
+    def _scan_range(self, start_row, stop_row, prefix, batch_size):
+        if prefix:
+            start_row = max(start_row, prefix)
+            prefix_stop = prefix_stop_row(prefix)
+            if prefix_stop is not None and (stop_row is None or prefix_stop < stop_row):
+                stop_row = prefix_stop
+        return start_row, stop_row, batch_size or self.backend.scan_batch_size
+
+
+class SaltedTable(Table):
+    salt_width = 2
+
+    def __init__(self, table, buckets):
+        if not 1 < buckets <= 16 ** self.salt_width:
+            raise ValueError('salt buckets must be in (1, %d]' % 16 ** self.salt_width)
+        super(SaltedTable, self).__init__(table.backend, table.table)
+        self.inner = table
+        self.buckets = buckets
+        self.salts = ['%0*x' % (self.salt_width, i) for i in range(buckets)]
+
+    def salt(self, row_key):
+        # history rows id-reversed_day share the bucket of their house id
+        key = row_key.split('-', 1)[0]
+        return self.salts[(zlib.crc32(key) & 0xffffffff) % self.buckets] + row_key
+
+    def unsalt(self, row_key):
+        return row_key[self.salt_width:]
+
+    def _unsalt_rows(self, rows):
+        for r in rows:
+            r.row = self.unsalt(r.row)
+        return rows
+
+    def _create_table(self, column_families, split_keys=None):
+        self.inner.create_table_if_not_exists(column_families, self.salts[1:])
+
+    def put(self, row_key, mutations):
+        self.inner.put(self.salt(row_key), mutations)
+
+    def put_rows(self, batch_mutations):
+        self.inner.put_rows([self.batch_mutation(self.salt(b.row), b.mutations) for b in batch_mutations])
+
+    def get(self, row_key, columns):
+        return self._unsalt_rows(self.inner.get(self.salt(row_key), columns))
+
+    def get_rows(self, row_keys, columns):
+        return self._unsalt_rows(self.inner.get_rows([self.salt(k) for k in row_keys], columns))
+
+    def delete(self, row_key):
+        self.inner.delete(self.salt(row_key))
+
+    def check_and_put(self, row_key, column, value, mutation):
+        return self.inner.check_and_put(self.salt(row_key), column, value, mutation)
+
+    def _scan_bucket(self, salt, start_row, stop_row, prefix, columns, row_regex, batch_size):
+        for r in self.inner.scan(start_row=salt + start_row,
+                                 stop_row=salt + stop_row if stop_row is not None else prefix_stop_row(salt),
+                                 prefix=salt + prefix if prefix else None,
+                                 columns=columns, row_regex=row_regex, batch_size=batch_size):
+            r.row = self.unsalt(r.row)
+            yield r.row, salt, r
+
+    def scan(self, start_row='', stop_row=None, prefix=None, columns=None, row_regex=None, batch_size=None):
+        # every bucket is scanned in parallel and merged back into row key order
+        scanners = [self._scan_bucket(salt, start_row, stop_row, prefix, columns, row_regex, batch_size)
+                    for salt in self.salts]
+        for _, _, r in heapq.merge(*scanners):
+            yield r
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+import logging
+
+from hbase import Hbase
+from scrapy import signals
+
+from house.storage import StorageUnavailable, backend_from_crawler
+
+logger = logging.getLogger(__name__)
+
+
+class DealWatermarks(object):
+    # one row per city and main area holding the newest deal date crawled, sold listings come newest
+    # first so the next run stops paging an area once its deals fall behind the watermark
+    column_family = 'cf'
+    qualifier = 'deal'
+
+    def __init__(self, storage, stats=None):
+        self.storage = storage
+        self.stats = stats
+        self.column = storage.column(self.column_family, self.qualifier)
+        self.watermarks = {}
+        self.advanced = {}
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        watermarks = getattr(crawler, 'deal_watermarks', None)
+        if watermarks is None:
+            table = crawler.settings.get('WATERMARK_TABLE', 'watermark')
+            watermarks = cls(backend_from_crawler(crawler).table(table), crawler.stats)
+            crawler.deal_watermarks = watermarks
+            crawler.signals.connect(watermarks.spider_opened, signal=signals.spider_opened)
+            crawler.signals.connect(watermarks.spider_closed, signal=signals.spider_closed)
+        return watermarks
+
+    @classmethod
+    def key(cls, city, area):
+        return (u'%s-%s' % (city, area)).encode('utf-8')
+
+    def spider_opened(self):
+        d = self.storage.backend.defer(self.load)
+        d.addErrback(self._load_failed)
+        return d
+
+    def load(self):
+        column_families = (Hbase.ColumnDescriptor(name=self.column_family, maxVersions=1),)
+        self.storage.create_table_if_not_exists(column_families)
+        self.watermarks = dict((r.row, r.columns[self.column].value) for r in self.storage.scan(columns=[self.column]))
+        logger.info('Loaded deal watermarks of %d areas.', len(self.watermarks))
+
+    def _load_failed(self, failure):
+        failure.trap(StorageUnavailable)
+        logger.warning('Cant load deal watermarks, crawl every sold page: %s', failure.value)
+
+    def get(self, key):
+        return self.watermarks.get(key)
+
+    def advance(self, key, deal):
+        # only once the area was paged down to the old watermark, a gap would never be crawled otherwise
+        if deal and deal > self.watermarks.get(key):
+            self.watermarks[key] = deal
+            self.advanced[key] = deal
+
+    def spider_closed(self):
+        if self.stats:
+            self.stats.set_value('watermarks/advanced', len(self.advanced))
+        if not self.advanced:
+            return
+        batch = [self.storage.batch_mutation(k, [self.storage.mutation(self.column_family, self.qualifier, v)])
+                 for k, v in self.advanced.items()]
+        self.advanced = {}
+        d = self.storage.backend.defer(self.storage.put_rows, batch)
+        d.addErrback(lambda f: logger.warning('Cant save %d deal watermarks: %s', len(batch), f.getErrorMessage()))
+        return d
@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+import unittest
+
+from house.commands.benchitems import kinds, typical, samples, load, normalize
+
+
+class NormalizerTest(unittest.TestCase):
+    # the listing callbacks build items with the normalizers, they must match the loaders value for value
+
+    def assertSame(self, kind, values):
+        self.assertEqual(load(kind, values), normalize(kind, values), '%s differs for %r' % (kind, values))
+
+    def test_typical(self):
+        for kind in kinds:
+            self.assertSame(kind, typical[kind])
+
+    def test_samples(self):
+        for kind, (_, item_class, _) in kinds.items():
+            for field in sorted(item_class.fields):
+                for sample in samples:
+                    self.assertSame(kind, {field: sample})
+                    self.assertSame(kind, dict(typical[kind], **{field: sample}))
+
+
+if __name__ == '__main__':
+    unittest.main()